@@ -1,13 +1,23 @@
 from typing import AsyncGenerator
+from contextlib import aclosing
 from .prompt import BasePrompt
 from .model import BaseModel
 from .client import MCPClientMaanger
+from .cache import ToolResultCache, PromptFragmentCache
+from .packing import ContextPacker
+from .prefetch import RetrievalPrefetch
 from .types import AgentResponse
+from .worker import GenerationWorker
 from . import errors
+from .toolcall import parse_tool_calls, ToolCallSyntaxError
+from .grammar import tool_call_grammar
 from . import utils
+import asyncio
+import copy
+import hashlib
 import json
-import re
 import logging
+import uuid
 
 
 SYSTEM_PROMPT = """You are a helpful assistant"""
@@ -52,19 +62,44 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 class Agent:
-    def __init__(self, name:str, model:BaseModel, prompt:BasePrompt) -> None:
+    def __init__(self, name:str, model:BaseModel, prompt:BasePrompt, generation_timeout:float|None=None, tool_timeout:float=30.0, tool_cache:ToolResultCache|None=None, tool_result_tokens:int|None=2048, prefetch:RetrievalPrefetch|None=None) -> None:
         self.name:str = name
 
         self.llm:BaseModel = model
         self.prompt:BasePrompt = prompt
 
-        self.mcp_manager = MCPClientMaanger()
+        #* the model runs on its own thread, the event loop only waits for its deltas
+        self.worker:GenerationWorker = GenerationWorker(model)
+        self.generation_timeout:float|None = generation_timeout
 
-        self.func_scheme_prompt = ""
-        self.resource_prompt = ""
+        #* history is cut by tokens, leaving room for the answer
+        self.prompt.set_token_budget(model.count_tokens, model.context_limit - model.max_tokens)
 
-        self.tool_pattern = re.compile(r'\[([A-Za-z0-9\_]+\(([A-Za-z0-9\_]+=\"?.+\"?,?\s?)*\),?\s?)+\]')
-        self.func_pattern = re.compile(r'(?P<function>[A-Za-z0-9\_]+)\((?P<params>[A-Za-z0-9\_]+=\"?.+\"?,?\s?)*\)')
+        self.mcp_manager = MCPClientMaanger(tool_cache=tool_cache)
+        self.tool_timeout:float = tool_timeout
+
+        #* tool results are cut down to the chunks most relevant to the question (None keeps them whole)
+        self.packer:ContextPacker|None = ContextPacker(model.count_tokens, tool_result_tokens) if tool_result_tokens else None
+
+        #* notes the question obviously refers to are read before the model runs
+        self.prefetch:RetrievalPrefetch|None = prefetch
+
+        #* the tool prompt and grammar rendered from the schemas, reused across restarts
+        self.fragment_cache:PromptFragmentCache = PromptFragmentCache()
+
+        self.tool_scheme = ""
+        self.tool_grammar = ""
+
+        # requests of forked agents are scheduled per session by the shared worker,
+        # this agent has its own session so cancel() never reaches the forks
+        self.session:str = uuid.uuid4().hex
+
+    async def get_resource_prompt(self, max_pages:int=1) -> str:
+        '''
+        the resources of the servers as json, fetched on demand: listing a large vault is
+        megabytes, so only the first `max_pages` pages of each server are read
+        '''
+        return json.dumps(await self.mcp_manager.get_resource_list(max_pages=max_pages))
 
     @property
     def model_name(self):
@@ -74,24 +109,58 @@ class Agent:
     def server_list(self):
         return self.mcp_manager.get_server_names()
     
-    def register_mcp(self, path:str):
-        self.mcp_manager.register_mcp(path)
+    def register_mcp(self, path:str, lazy:bool=False):
+        self.mcp_manager.register_mcp(path, lazy=lazy)
 
     async def init_agent(self):
         await self.mcp_manager.init_mcp_client()
 
         func_scheme_list = await self.mcp_manager.get_func_scheme()
-        resource_list = await self.mcp_manager.get_resource_list()
 
-        self.func_scheme_prompt = json.dumps(func_scheme_list)
-        self.resource_prompt = json.dumps(resource_list)
+        #* the tool prompt is rendered once, so every turn has byte-identical text (and kv cache) for it
+        templates = hashlib.sha256(TOOL_CALL_PROMPT.encode()).hexdigest()
+        key = f"{self.mcp_manager.schema_hash}:{templates}"
+
+        if (fragments := self.fragment_cache.get(key)) is None:
+            fragments = {
+                'tool_scheme':TOOL_CALL_PROMPT.format(function_scheme=json.dumps(func_scheme_list)),
+                #* the tool selection can only produce valid calls of these tools, or a plain answer
+                'tool_grammar':tool_call_grammar(func_scheme_list),
+            }
+            self.fragment_cache.put(key, fragments)
+
+        self.tool_scheme = fragments['tool_scheme']
+        self.tool_grammar = fragments['tool_grammar']
         
         p = self.prompt.get_system_prompt(SYSTEM_PROMPT)
         self.prompt.set_system_prompt(p)
 
     async def clean_agent(self):
+        await asyncio.to_thread(self.worker.close)
         await self.mcp_manager.clean_mcp_client()
 
+    def cancel(self):
+        '''stop the answer being generated, chat_stream ends with the text generated so far'''
+        self.worker.cancel(session=self.session)
+
+    def cancel_all(self):
+        '''stop the answers being generated for this agent and every agent forked from it'''
+        self.worker.cancel()
+
+    def fork(self, prompt:BasePrompt, session:str) -> 'Agent':
+        '''
+        an agent with its own history sharing the model, worker and MCP clients of this one.
+        it is not entered nor cleaned, the resources belong to this agent
+        '''
+        agent = copy.copy(self)
+        agent.prompt = prompt
+        agent.session = session
+
+        prompt.set_token_budget(self.llm.count_tokens, self.llm.context_limit - self.llm.max_tokens)
+        prompt.set_system_prompt(prompt.get_system_prompt(SYSTEM_PROMPT))
+
+        return agent
+
     async def __aenter__(self):
         await self.init_agent()
 
@@ -100,73 +169,134 @@ class Agent:
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.clean_agent()
 
-    def _is_tool_required(self, response:str):
-        return self.tool_pattern.match(response)
-
-    def get_func_props(self, response:str):
-        for signature in response.strip('[]').split(','):
-            signature = signature.strip()
-
-            if res := self.func_pattern.findall(signature):
-                name, param_string = res[0]
-                yield name, utils.param2dict(param_string)
-
-    async def get_result_tool(self, response:str) -> list[list[str]]:
-        result_list = []
+    def _is_tool_required(self, response:str) -> bool:
+        return bool(self.get_func_props(response))
+
+    def get_func_props(self, response:str) -> list[tuple[str, dict]]:
+        '''(name, params) of the tool calls in a response, empty for a plain answer or a malformed call'''
+        try:
+            return parse_tool_calls(response) or []
+        except ToolCallSyntaxError as e:
+            logger.debug(f"response is not a valid tool call ({e})")
+            return []
+
+    async def _call_tool(self, name:str, param:dict) -> dict:
+        try:
+            is_err, content_list = await asyncio.wait_for(self.mcp_manager.call_tool(name, param), self.tool_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"mcp function({name}) with param({param}) timed out after {self.tool_timeout}s")
+            return {'name':name, 'error':f"timed out after {self.tool_timeout}s"}
+        except Exception as e:
+            logger.warning(f"mcp function({name}) with param({param}) failed ({e!r})")
+            return {'name':name, 'error':str(e) or type(e).__name__}
+
+        logger.debug(f"mcp function({name}) with param({param}) has results({content_list})")
+
+        results = [c.text for c in content_list]
+        return {'name':name, 'output':results}
+
+    async def get_result_tool(self, response:str) -> list[dict]:
+        '''
+        runs the tool calls of a response concurrently, results are in the order of the calls.
+        a failed or timed out call gets an `error` instead of an `output`, the others are kept
+        '''
+        calls = [self._call_tool(name, param) for name, param in self.get_func_props(response)]
+        return list(await asyncio.gather(*calls))
+
+    async def _prefetch(self, question:str) -> str:
+        '''the tool calls reading the notes matching the question, empty when the match is not clear'''
+        prefetch = self.prefetch
+        if not {prefetch.search_tool, prefetch.read_tool} <= self.mcp_manager.tool_map.keys():
+            return ''
+
+        result = await self._call_tool(prefetch.search_tool, prefetch.search_args(question))
+        uris, reason = prefetch.select(question, prefetch.parse_hits(result.get('output', [])))
+        prefetch.record(bool(uris), reason if 'output' in result else f"search failed: {result['error']}")
+
+        return prefetch.tool_call(uris) if uris else ''
+
+    def _stream(self, prompt:str, **kwargs) -> aclosing[AsyncGenerator[str, None]]:
+        #* closed on exit, so a consumer that stops early cancels the generation right away
+        return aclosing(self.worker.stream(prompt, timeout=self.generation_timeout, session=self.session, **kwargs))
+
+    async def chat_stream(self, question:str, **kwargs) -> AsyncGenerator[AgentResponse, None]:
+        '''
+        same as `chat`, but the text is also emitted piece by piece (partial=True) while it is generated.
+        a response starting with `[` may be a tool call, so it is held back until it is complete
+        '''
+        logger.debug(f"agent got question({question})")
 
-        for name, param in self.get_func_props(response):
-            res = await self.mcp_manager.call_tool(name, param)
-            is_err, content_list = res
-            logger.debug(f"mcp function({name}) with param({param}) has results({content_list})")
+        p = self.prompt.get_user_prompt(question=question, tool_scheme=self.tool_scheme)
+        self.prompt.append_history(p)
 
-            results = [c.text for c in content_list]
+        response, streaming = '', False
+        if self.prefetch and (calls := await self._prefetch(question)):
+            # the matching notes are read right away, the model only writes the answer
+            response = calls
 
-            result_list.append({'name':name, 'output':results})
-        
-        return result_list
+        else:
+            tool_kwargs = {'grammar':self.tool_grammar, **kwargs}
+            async with self._stream(self.prompt.get_generation_prompt(tool_enabled=True), **tool_kwargs) as deltas:
+                async for delta in deltas:
+                    response += delta
 
-    async def chat(self, question:str, **kwargs) -> list[AgentResponse]:
-        response_list = []
+                    if streaming:
+                        yield AgentResponse(type="text", data=delta, partial=True)
 
-        logger.debug(f"agent got question({question})")
+                    elif (head := response.strip()) and not head.startswith('['):
+                        streaming = True
+                        yield AgentResponse(type="text", data=head, partial=True)
 
-        tool_scheme = TOOL_CALL_PROMPT.format(
-            function_scheme=self.func_scheme_prompt
-            )
-        
-        p = self.prompt.get_user_prompt(question=question, tool_scheme=tool_scheme)
-        self.prompt.append_history(p)
-        
-        response = self.llm.generate(self.prompt.get_generation_prompt(tool_enabled=True), **kwargs)
-        response = response.strip().lstrip('()<>\\{\\}`') #! remove noise (temporal)
+            response = response.strip()
 
         logger.debug(f"llm generated response ({response})")
 
-        if self._is_tool_required(response):
+        if not streaming and self._is_tool_required(response):
             logger.debug(f"agent tool required")
-            response_list.append(AgentResponse(type="tool-calling", data=response))
+            yield AgentResponse(type="tool-calling", data=response)
 
             p = self.prompt.get_assistant_prompt(answer=response)
             self.prompt.append_history(p)
 
             result = await self.get_result_tool(response)
+
+            dropped = []
+            if self.packer:
+                result, dropped = self.packer.pack(result, question)
+                if dropped:
+                    logger.debug(f"dropped {len(dropped)} chunks ({sum(d['tokens'] for d in dropped)} tokens) of the tool results")
+
             result = json.dumps(result, ensure_ascii=False)
 
-            response_list.append(AgentResponse(type="tool-result", data=result))
+            yield AgentResponse(type="tool-result", data=result, dropped=dropped)
 
             logger.debug(f"got result of each tool ({result})")
 
             p = self.prompt.get_tool_result_prompt(result=result)
             self.prompt.append_history(p)
 
-            response = self.llm.generate(self.prompt.get_generation_prompt(tool_enabled=False, last=3), **kwargs)
+            response = ''
+            async with self._stream(self.prompt.get_generation_prompt(tool_enabled=False, last=3), **kwargs) as deltas:
+                async for delta in deltas:
+                    if not response:
+                        delta = delta.lstrip()
+                        if not delta:
+                            continue
+
+                    response += delta
+                    yield AgentResponse(type="text", data=delta, partial=True)
+
+            response = response.strip()
 
             logger.debug(f"llm generated final response({response})")
 
-        response_list.append(AgentResponse(type="text", data=response))
+        elif not streaming and response:
+            yield AgentResponse(type="text", data=response, partial=True)
+
+        yield AgentResponse(type="text", data=response)
 
         p = self.prompt.get_assistant_prompt(answer=response)
         self.prompt.append_history(p)
 
-        return response_list
-
+    async def chat(self, question:str, **kwargs) -> list[AgentResponse]:
+        return [r async for r in self.chat_stream(question, **kwargs) if not r.partial]
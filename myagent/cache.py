@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from typing import Any
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('agent.cache')
+
+#* these tools only read the vault, their results can be cached until the vault changes
+VAULT_READ_TOOLS = {
+    'list_docs', 'get_doc_by_uri', 'get_docs_by_uris', 'get_doc_outline', 'get_doc_section',
+    'get_outlinks', 'get_backlinks', 'related_docs', 'query_docs', 'search_docs',
+}
+
+#* only the server's change notifications drop cached tool results, the vault server announces
+#* them when it watches the vault (WATCH_MODE in config.json)
+CACHE_TOOL_RESULTS = os.environ.get('CACHE_TOOL_RESULTS', '') == '1'
+
+
+class ToolResultCache:
+    '''
+    LRU cache of tool results keyed by (server, tool, normalized arguments)
+
+    only the given read-only tools are cached. entries expire after `ttl` seconds, and all entries
+    of a server are dropped when it notifies that its resources changed (the client only caches
+    servers announcing these notifications).
+    '''
+    def __init__(self, tools:set[str]|None=None, ttl:float=300.0, max_entries:int=256) -> None:
+        self.tools:set[str] = set(tools or [])
+        self.ttl:float = ttl
+        self.max_entries:int = max_entries
+
+        self._entries:OrderedDict[tuple[int, str, str], tuple[float, Any]] = OrderedDict()
+
+        self.hits:int = 0
+        self.misses:int = 0
+        self.invalidations:int = 0
+
+    def cacheable(self, name:str) -> bool:
+        return name in self.tools
+
+    @staticmethod
+    def _key(server:int, name:str, args:dict) -> tuple[int, str, str]:
+        return server, name, json.dumps(args, sort_keys=True, ensure_ascii=False, default=str)
+
+    def get(self, server:int, name:str, args:dict) -> Any | None:
+        key = self._key(server, name, args)
+        entry = self._entries.get(key)
+
+        if entry is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        logger.debug(f"tool cache {'hit' if entry else 'miss'} for {name}, hit rate {self.hit_rate:.2%} ({self.hits}/{self.hits + self.misses})")
+        return entry[1] if entry else None
+
+    def put(self, server:int, name:str, args:dict, result:Any):
+        key = self._key(server, name, args)
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, server:int):
+        stale = [key for key in self._entries if key[0] == server]
+        for key in stale:
+            del self._entries[key]
+
+        self.invalidations += 1
+        logger.debug(f"tool cache invalidated for server {server} ({len(stale)} entries)")
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'invalidations':self.invalidations,
+            'hit_rate':round(self.hit_rate, 4),
+            'entries':len(self._entries),
+        }
+
+
+class PromptFragmentCache:
+    '''
+    prompt fragments rendered from the tool schemas (tool prompt, grammar, ...), kept on disk
+
+    entries are keyed by a hash of the schemas and templates they were rendered from, so a restart
+    with the same servers reuses the exact same text. the `max_entries` latest keys are kept
+    '''
+    def __init__(self, path:str|None='.agent_cache/prompt_fragments.json', max_entries:int=8) -> None:
+        self.path:str|None = path
+        self.max_entries:int = max_entries
+
+        self._entries:dict[str, dict[str, str]] = self._load()
+
+    def _load(self) -> dict[str, dict[str, str]]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, 'r') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            logger.warning(f"broken prompt fragment cache({self.path}), ignored")
+            return {}
+
+    def _save(self):
+        if not self.path:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as fd:
+            json.dump(self._entries, fd, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key:str) -> dict[str, str] | None:
+        fragments = self._entries.get(key)
+        logger.debug(f"prompt fragments {'reused' if fragments else 'rendered'} for schemas {key[:12]}")
+
+        return fragments
+
+    def put(self, key:str, fragments:dict[str, str]):
+        self._entries.pop(key, None)
+        self._entries[key] = fragments
+
+        # dicts keep insertion order, the oldest keys come first
+        while len(self._entries) > self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+        self._save()
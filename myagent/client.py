@@ -1,120 +1,367 @@
 import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import AsyncGenerator, Callable
 from contextlib import AsyncExitStack
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 from mcp import types
 
+from .cache import ToolResultCache
 from . import utils
 from . import errors
 
+logger = logging.getLogger('agent.client')
+
 class MCPClient:
-    def __init__(self):
+    def __init__(self, on_resources_changed:Callable[[], None]|None=None):
         self.session = None
         self.name = ''
-        self.exit_stack = AsyncExitStack()
+        self.capabilities:types.ServerCapabilities|None = None
+        self.on_resources_changed = on_resources_changed
+        self._closing:asyncio.Event|None = None
+        self._task:asyncio.Task|None = None
+
+    @property
+    def connected(self) -> bool:
+        return self.session is not None
+
+    @property
+    def notifies_changes(self) -> bool:
+        '''whether the server announced resource list changed notifications'''
+        resources = self.capabilities.resources if self.capabilities else None
+        return bool(resources and resources.listChanged)
 
     async def connect_to_server(self, server_script_path:str):
+        '''
+        the stdio transport and the session are entered and exited by one background task
+        (anyio scopes must be exited by the task that entered them), so several servers can
+        be connected concurrently and closed from anywhere
+        '''
+        ready = asyncio.get_running_loop().create_future()
+        self._closing = asyncio.Event()
+        self._task = asyncio.create_task(self._serve(server_script_path, ready))
+
+        await ready
+
+    async def _serve(self, server_script_path:str, ready:asyncio.Future):
         server_params = StdioServerParameters(
             command = "python",
             args=[server_script_path],
             env=None
         )
 
-        # spawaning a process for running a mcp server
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        self.read, self.write = stdio_transport
+        try:
+            async with AsyncExitStack() as exit_stack:
+                # spawaning a process for running a mcp server
+                stdio_transport = await exit_stack.enter_async_context(stdio_client(server_params))
+                self.read, self.write = stdio_transport
+
+                # init session using read/write pipes of the process spawned
+                session = await exit_stack.enter_async_context(ClientSession(self.read, self.write, message_handler=self._handle_message))
+
+                # connect server by sending initialize request
+                init_result = await session.initialize()
+                server_info = init_result.serverInfo
+                self.name = f"{server_info.name}(v{server_info.version})"
+                self.capabilities = init_result.capabilities
+                self.session = session
 
-        # init session using read/write pipes of the process spawned
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.read, self.write))
+                ready.set_result(None)
+                await self._closing.wait()
 
-        # connect server by sending initialize request
-        init_result = await self.session.initialize()
-        server_info = init_result.serverInfo
-        self.name = f"{server_info.name}(v{server_info.version})"
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.error(f"mcp server({self.name}) connection failed ({e!r})")
+
+        finally:
+            self.session = None
+
+    async def _handle_message(self, message):
+        if not isinstance(message, types.ServerNotification):
+            return
+
+        if isinstance(message.root, (types.ResourceListChangedNotification, types.ResourceUpdatedNotification)):
+            if self.on_resources_changed:
+                self.on_resources_changed()
 
     async def list_tools(self) -> list[types.Tool]:
         response = await self.session.list_tools()
         tools = response.tools
         return tools
 
-    async def list_resources(self) -> list[types.Resource]:
-        response = await self.session.list_resources()
-        resources = response.resources
-        return resources
+    async def list_resources(self, cursor:str|None=None) -> tuple[list[types.Resource], str|None]:
+        '''one page of resources and the cursor of the next page (None on the last page)'''
+        #! ClientSession.list_resources of mcp 1.6 does not take a cursor
+        response = await self.session.send_request(
+            types.ClientRequest(types.ListResourcesRequest(method="resources/list", cursor=cursor)),
+            types.ListResourcesResult,
+        )
+        return response.resources, response.nextCursor
+
+    async def iter_resources(self) -> AsyncGenerator[list[types.Resource], None]:
+        cursor = None
+        while True:
+            resources, cursor = await self.list_resources(cursor)
+            yield resources
+
+            if not cursor:
+                break
     
     async def call_tool(self, name, args) -> tuple[bool, list[types.TextContent]]:
         response = await self.session.call_tool(name, args)
         return [response.isError, response.content]
 
     async def cleanup(self):
-        await self.exit_stack.aclose()
+        if self._task is not None:
+            self._closing.set()
+            await self._task
+            self._task = None
 
 class MCPClientMaanger:
-    def __init__(self):
+    def __init__(self, max_concurrent_calls:int=4, schema_cache_path:str|None='.agent_cache/tool_schemas.json', tool_cache:ToolResultCache|None=None):
         self.server_path:list[str] = []
+        self.lazy:list[bool] = []
         self.clients:list[MCPClient] = []
 
+        #* tool calls in flight per server, so a burst of calls does not flood one server
+        self.max_concurrent_calls:int = max_concurrent_calls
+        self.call_limits:list[asyncio.Semaphore] = []
+        self._connect_locks:list[asyncio.Lock] = []
+
+        #* tool schemas of every server seen so far, a lazy server is started on its first call
+        self.schema_cache_path:str|None = schema_cache_path
+        self.schema_cache:dict[str, dict] = self._load_schema_cache()
+        self._schema_changed:bool = False
+        #* (name, hash) of the schemas get_func_scheme handed out, per server
+        self._listed:dict[int, tuple[str, str]] = {}
+
+        #* opt-in cache of read-only tool results
+        self.tool_cache:ToolResultCache|None = tool_cache
+
         self.tool_map:dict[str, int] = dict()
         self.tool_info:dict[str, dict[str, str]] = dict()
         self.resource_map:dict[str, int] = dict()
 
-    def register_mcp(self, server_path:str):
+    def register_mcp(self, server_path:str, lazy:bool=False):
         '''
         register mcp client/server (server script path)
         it only supports stdio mcp server (for now)
+
+        a lazy server is only started when one of its tools is called,
+        as long as its tool schema is cached from a previous run
         '''
         self.server_path.append(server_path)
+        self.lazy.append(lazy)
+
+    def _load_schema_cache(self) -> dict[str, dict]:
+        if not self.schema_cache_path or not os.path.exists(self.schema_cache_path):
+            return {}
+
+        try:
+            with open(self.schema_cache_path, 'r') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            logger.warning(f"broken tool schema cache({self.schema_cache_path}), ignored")
+            return {}
+
+    def _save_schema_cache(self):
+        if not self.schema_cache_path:
+            return
+
+        os.makedirs(os.path.dirname(self.schema_cache_path) or '.', exist_ok=True)
+
+        tmp_path = f"{self.schema_cache_path}.tmp"
+        with open(tmp_path, 'w') as fd:
+            json.dump(self.schema_cache, fd)
+        os.replace(tmp_path, self.schema_cache_path)
+
+    def _cached_schema(self, idx:int) -> dict | None:
+        '''
+        cached schema of a server, as long as its script did not change since
+        (the server-reported name and the tool hash are checked again once a lazy server is started)
+        '''
+        path = self.server_path[idx]
+        entry = self.schema_cache.get(os.path.abspath(path))
+
+        if entry is None or not os.path.exists(path) or entry['mtime_ns'] != os.stat(path).st_mtime_ns:
+            return None
+
+        return entry
+
+    async def _connect(self, idx:int) -> MCPClient:
+        async with self._connect_locks[idx]:
+            c = self.clients[idx]
+            if c.connected:
+                return c
+
+            start = time.perf_counter()
+            await c.connect_to_server(self.server_path[idx])
+            logger.info(f"mcp server({c.name}) at {self.server_path[idx]} started in {time.perf_counter() - start:.2f}s")
+
+            if self.tool_cache and not c.notifies_changes:
+                logger.info(f"mcp server({c.name}) does not notify resource changes, its tool results are not cached")
+
+            #* a lazy server was announced from the cache, check it against what the server reports now
+            if (listed := self._listed.get(idx)) is not None:
+                self._schema_changed = False
+                await self._list_tools(idx)
+                if self._schema_changed:
+                    self._save_schema_cache()
+
+                if self._listed[idx] != listed:
+                    logger.warning(f"tool schemas of mcp server({c.name}) differ from the cached ones, they apply from the next get_func_scheme")
+
+            return c
+
+    def _resources_changed(self, idx:int) -> Callable[[], None]:
+        def invalidate():
+            if self.tool_cache:
+                self.tool_cache.invalidate(idx)
+
+        return invalidate
 
     async def init_mcp_client(self):
-        for path in self.server_path:
-            c = MCPClient()
-            await c.connect_to_server(path)
+        '''starts the (non-lazy) servers concurrently'''
+        self.clients = [MCPClient(on_resources_changed=self._resources_changed(idx)) for idx in range(len(self.server_path))]
+        self.call_limits = [asyncio.Semaphore(self.max_concurrent_calls) for _ in self.server_path]
+        self._connect_locks = [asyncio.Lock() for _ in self.server_path]
+
+        connect = []
+        for idx, c in enumerate(self.clients):
+            if self.lazy[idx] and (schema := self._cached_schema(idx)):
+                c.name = schema['name']
+            else:
+                connect.append(self._connect(idx))
 
-            self.clients.append(c)
+        start = time.perf_counter()
+        await asyncio.gather(*connect)
+        logger.info(f"{len(connect)} of {len(self.clients)} mcp servers started in {time.perf_counter() - start:.2f}s")
 
     async def clean_mcp_client(self):
-        for c in self.clients:
-            await c.cleanup()
+        await asyncio.gather(*[c.cleanup() for c in self.clients])
 
     def get_server_names(self):
         return list(filter(lambda x:x, [c.name for c in self.clients]))
-    
+
+    async def _list_tools(self, idx:int) -> list[types.Tool]:
+        '''tools of a server sorted by name, so the prompt built from them does not depend on their order'''
+        c = self.clients[idx]
+        if not c.connected:
+            entry = self._cached_schema(idx)
+            self._listed[idx] = (entry['name'], entry['hash'])
+
+            tools = [types.Tool.model_validate(tool) for tool in entry['tools']]
+            return sorted(tools, key=lambda tool:tool.name)
+
+        tools = sorted(await c.list_tools(), key=lambda tool:tool.name)
+        dumped = [tool.model_dump(mode='json') for tool in tools]
+        schema_hash = hashlib.sha256(json.dumps(dumped, sort_keys=True).encode()).hexdigest()
+
+        path = self.server_path[idx]
+        entry = {
+            'mtime_ns':os.stat(path).st_mtime_ns if os.path.exists(path) else 0,
+            'name':c.name,
+            'hash':schema_hash,
+            'tools':dumped,
+        }
+
+        self._listed[idx] = (c.name, schema_hash)
+
+        key = os.path.abspath(path)
+        if self.schema_cache.get(key) != entry:
+            logger.debug(f"tool schemas of mcp server({c.name}) changed, cache updated")
+            self.schema_cache[key] = entry
+            self._schema_changed = True
+
+        return tools
+
+    @property
+    def schema_hash(self) -> str:
+        '''
+        hash of the servers (name and version) and the tool schemas the last get_func_scheme returned,
+        in the order they were registered
+        '''
+        servers = [self._listed.get(idx, (None, None)) for idx in range(len(self.server_path))]
+        return hashlib.sha256(json.dumps(servers).encode()).hexdigest()
+
     async def get_func_scheme(self) -> list[dict[str, str]]:
         func_scheme_list = []
 
-        for idx, c in enumerate(self.clients):
-            tools = await c.list_tools()
+        self._schema_changed = False
+        tool_lists = await asyncio.gather(*[self._list_tools(idx) for idx in range(len(self.clients))])
 
+        #* the listed schemas are compared with the cached ones, the file is only rewritten when one changed
+        if self._schema_changed:
+            self._save_schema_cache()
+
+        for idx, tools in enumerate(tool_lists):
             for tool in tools:
                 func_scheme_list.append(utils.tool2dict(tool))
                 self.tool_map[tool.name] = idx
-                
+
                 func_info = self.tool_info.get(self.clients[idx].name, {})
                 func_info[tool.name] = tool.description
                 self.tool_info[self.clients[idx].name] = func_info
 
         return func_scheme_list
 
-    async def get_resource_list(self) -> list[dict[str, str]]:
+    async def _list_resources(self, idx:int, max_pages:int|None=None) -> list[types.Resource]:
+        resource_list, pages = [], 0
+        async for resources in self.clients[idx].iter_resources():
+            resource_list += resources
+            pages += 1
+
+            if max_pages and pages >= max_pages:
+                break
+
+        return resource_list
+
+    async def get_resource_list(self, max_pages:int|None=None) -> list[dict[str, str]]:
+        '''
+        resources of the running servers (a lazy server not started yet has none),
+        at most `max_pages` pages per server (None walks every page)
+        '''
         resource_list = []
 
-        for idx, c in enumerate(self.clients):
-            resources = await c.list_resources()
-            
+        running = [idx for idx, c in enumerate(self.clients) if c.connected]
+        resource_lists = await asyncio.gather(*[self._list_resources(idx, max_pages) for idx in running])
+
+        for idx, resources in zip(running, resource_lists):
             for rsrc in resources:
                 resource_list.append(utils.resource2dict(rsrc))
                 self.resource_map[utils.uri2path(rsrc.uri)] = idx
 
+        #* servers may list their resources in any order
+        resource_list.sort(key=lambda rsrc:rsrc['uri'])
+
         return resource_list
     
+    def _cacheable(self, idx:int, name:str) -> bool:
+        '''only servers notifying resource changes get their results cached, the others could serve them stale'''
+        return self.tool_cache is not None and self.tool_cache.cacheable(name) and self.clients[idx].notifies_changes
+
     async def call_tool(self, name, param) -> tuple[bool, list[types.TextContent]]:
         idx = self.tool_map.get(name, -1)
 
         if idx < 0:
-            raise errors.MCPException(f"Unknown tool name{name}")
+            raise errors.MCPException(f"Unknown tool name({name})")
         
-        client = self.clients[idx]
-        result = await client.call_tool(name, param)
+        if self._cacheable(idx, name) and (result := self.tool_cache.get(idx, name, param)) is not None:
+            return result
+
+        client = await self._connect(idx)
+        async with self.call_limits[idx]:
+            result = await client.call_tool(name, param)
+
+        is_err, _ = result
+        if not is_err and self._cacheable(idx, name):
+            self.tool_cache.put(idx, name, param, result)
         
         return result
         
@@ -127,7 +374,7 @@ async def test():
         tools = await client.list_tools()
         print(tools)
 
-        rsrc_list = await client.list_resources()
+        rsrc_list, _ = await client.list_resources()
         for rsrc in rsrc_list[:5]:
             print(rsrc)
 
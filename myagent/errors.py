@@ -3,4 +3,10 @@ class AgentException(Exception):
     pass
 
 class MCPException(AgentException):
-    pass
\ No newline at end of file
+    pass
+
+class GenerationTimeout(AgentException):
+    pass
+
+class ServiceBusy(AgentException):
+    pass
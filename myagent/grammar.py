@@ -0,0 +1,92 @@
+import json
+import re
+
+#* json-ish values shared by every tool, the same syntax `toolcall.parse_tool_calls` reads
+VALUE_RULES = r'''
+string ::= "\"" ([^"\\\x7F\x00-\x1F] | "\\" (["\\/bfnrt] | "u" [0-9a-fA-F]{4}))* "\""
+integer ::= "-"? [0-9]{1,15}
+number ::= integer ("." [0-9]{1,15})? ([eE] [-+]? [0-9]{1,3})?
+boolean ::= "True" | "False" | "true" | "false"
+value ::= string | number | boolean | "null" | array | object
+array ::= "[" ws (value ("," ws value)*)? "]"
+object ::= "{" ws (string ":" ws value ("," ws string ":" ws value)*)? "}"
+ws ::= " "?
+'''
+
+TYPE_RULES = {
+    'string':'string',
+    'integer':'integer',
+    'number':'number',
+    'boolean':'boolean',
+    'array':'array',
+    'object':'object',
+}
+
+
+def _rule_name(*parts:str) -> str:
+    return '-'.join(re.sub(r'[^A-Za-z0-9]', '-', p) for p in parts)
+
+
+def _literal(s:str) -> str:
+    return json.dumps(s)
+
+
+def _tool_rules(scheme:dict) -> tuple[str, list[str]]:
+    '''
+    rule of one call: the parameters in schema order, required ones always present.
+    `args{i}-first` / `args{i}-next` are the parameters from i on, before / after one was written
+    '''
+    name = scheme['name']
+    params = scheme['parameters']
+    required = set(params.get('required', []))
+    props = list(params.get('properties', {}).items())
+
+    base = _rule_name('call', name)
+    rules = []
+
+    def arg(i:int) -> str:
+        key, prop = props[i]
+        return f"{_literal(key + '=')} {TYPE_RULES.get(prop.get('type'), 'value')}"
+
+    def define(i:int, first:bool, *parts:str) -> str:
+        rule = f"{base}-args{i}-{'first' if first else 'next'}"
+        rules.append(f"{rule} ::= {' '.join(p for p in parts if p)}")
+        return rule
+
+    first, rest = '', ''
+    for i in range(len(props) - 1, -1, -1):
+        if props[i][0] in required:
+            first, rest = define(i, True, arg(i), rest), define(i, False, '","', 'ws', arg(i), rest)
+        elif first:
+            first, rest = define(i, True, arg(i), rest, '|', first), define(i, False, f'("," ws {arg(i)})?', rest)
+        else:
+            first, rest = define(i, True, f"({arg(i)})?"), define(i, False, f'("," ws {arg(i)})?')
+
+    rules.append(' '.join(p for p in [base, '::=', _literal(name + '('), first, '")"'] if p))
+    return base, rules
+
+
+def tool_call_grammar(func_scheme_list:list[dict]) -> str:
+    '''
+    GBNF grammar accepting either a list of valid calls of the given tools (`tool2dict` schemas),
+    `[f(a="x"), g()]`, or a plain answer that does not start with `[`, nor with the characters the model wraps calls in.
+    nothing may follow the closing bracket, so decoding stops as soon as the calls are closed
+    '''
+    if not func_scheme_list:
+        return ''
+
+    calls, rules = [], []
+    for scheme in func_scheme_list:
+        call, tool_rules = _tool_rules(scheme)
+        calls.append(call)
+        rules += tool_rules
+
+    head = [
+        r'root ::= [ \t\n]{0,4} (calls | answer)',
+        # an answer cannot start like a wrapped call either: `[f()]`, ([f()]), <[f()]>, {[f()]}
+        r'answer ::= [^\[ \t\n()<>{}`\\] [^\x00]*',
+        'calls ::= "[" call ("," ws call)* "]"',
+        f"call ::= {' | '.join(calls)}",
+    ]
+
+    return '\n'.join(head + rules) + VALUE_RULES
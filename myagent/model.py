@@ -1,31 +1,356 @@
+from typing import Iterator
 from typing_extensions import Self
-from llama_cpp import Llama
+from contextlib import closing, nullcontext
+from functools import lru_cache
+from llama_cpp import Llama, LlamaGrammar, StoppingCriteriaList
+from llama_cpp import _internals
+import llama_cpp
 from .types import BaseModel
+from .state import PromptStateCache, capture, restore
+from .speculative import GGUFDraftModel, prompt_lookup, drafting
+from .utils import available_bytes, memory_usage
+import logging
+import numpy as np
 import os
+import time
+
+logger = logging.getLogger('agent.model')
+
+#* kv cache types: (ggml type, bytes per element)
+KV_CACHE_TYPES = {
+    'f32':(llama_cpp.GGML_TYPE_F32, 4.0),
+    'f16':(llama_cpp.GGML_TYPE_F16, 2.0),
+    'q8_0':(llama_cpp.GGML_TYPE_Q8_0, 34 / 32),
+    'q5_1':(llama_cpp.GGML_TYPE_Q5_1, 24 / 32),
+    'q5_0':(llama_cpp.GGML_TYPE_Q5_0, 22 / 32),
+    'q4_1':(llama_cpp.GGML_TYPE_Q4_1, 20 / 32),
+    'q4_0':(llama_cpp.GGML_TYPE_Q4_0, 18 / 32),
+}
+
+#* context sizes are multiples of this
+CTX_STEP = 256
+
+
+def read_metadata(model_path:str) -> dict[str, str]:
+    '''GGUF metadata, only the vocabulary is loaded'''
+    params = llama_cpp.llama_model_default_params()
+    params.vocab_only = True
+
+    model = _internals.LlamaModel(path_model=model_path, params=params, verbose=False)
+    try:
+        return model.metadata()
+    finally:
+        model.close()
+
+
+def kv_shape(metadata:dict[str, str]) -> tuple[int, int, int, int] | None:
+    '''(layers, kv heads, key size, value size) of the kv cache, None when the metadata does not tell'''
+    try:
+        arch = metadata['general.architecture']
+        n_layer = int(metadata[f"{arch}.block_count"])
+        n_head = int(metadata[f"{arch}.attention.head_count"])
+        n_head_kv = int(metadata.get(f"{arch}.attention.head_count_kv", n_head))
+        n_embd = int(metadata[f"{arch}.embedding_length"])
+
+        k_dim = int(metadata.get(f"{arch}.attention.key_length", n_embd // n_head))
+        v_dim = int(metadata.get(f"{arch}.attention.value_length", n_embd // n_head))
+    except (KeyError, ValueError):
+        # e.g. per-layer head counts
+        return None
+
+    return n_layer, n_head_kv, k_dim, v_dim
+
+
+def kv_bytes_per_token(shape:tuple[int, int, int, int] | None, type_k:str='f16', type_v:str='f16') -> float:
+    '''size of the kv cache of one token (0 when the shape is unknown)'''
+    if shape is None:
+        return 0.0
+
+    n_layer, n_head_kv, k_dim, v_dim = shape
+    return n_layer * n_head_kv * (k_dim * KV_CACHE_TYPES[type_k][1] + v_dim * KV_CACHE_TYPES[type_v][1])
+
+
+@lru_cache(maxsize=16)
+def parse_grammar(grammar:str) -> LlamaGrammar:
+    '''parsed once per source text, the tool-call grammar only changes with the tool list'''
+    return LlamaGrammar.from_string(grammar, verbose=False)
+
+
+def resize_context(model:Llama, n_ctx:int):
+    '''
+    replaces the context of a loaded model by one of `n_ctx` tokens, the way `Llama.__init__` creates it.
+    the old kv cache is freed first, so only the new one is allocated on top of the weights
+    '''
+    #! llama-cpp-python has no public api for this, it relies on the attributes of 0.3.x
+    model._ctx.close()
+
+    model.context_params.n_ctx = n_ctx
+    model._ctx = model._stack.enter_context(
+        closing(_internals.LlamaContext(model=model._model, params=model.context_params, verbose=model.verbose))
+    )
+
+    model._n_ctx = model.n_ctx()
+    model.n_tokens = 0
+    model.input_ids = np.ndarray((n_ctx,), dtype=np.intc)
+    if model.context_params.logits_all:
+        model.scores = np.ndarray((n_ctx, model.n_vocab()), dtype=np.single)
 
 
 class LlamaCPP(BaseModel):
-    def __init__(self, name:str, model:Llama):
+    #* a diverging prompt saves the current kv cache first if it would throw away at least this many tokens
+    MIN_CHECKPOINT_TOKENS = 256
+
+    def __init__(
+        self, name:str, model:Llama, state_cache:PromptStateCache|None=None, context_limit:int=0,
+        draft:Llama|None=None
+    ):
         self.name = name
         self.model = model
         self.max_tokens = 1024
 
+        self.state_cache = state_cache
+        self.last_usage:dict[str, int] = {}
+
+        #* the context can be re-created up to this size when a conversation outgrows it
+        self.context_limit:int = max(context_limit, model.n_ctx())
+
+        #* small model sharing the vocabulary, for speculative="draft"
+        self.draft:Llama|None = draft
+
     @classmethod
-    def from_path(cls, model_path:str, n_ctx:int=131072, **kwargs) -> Self:
-        model = Llama(
-            model_path=model_path,
-            n_ctx=n_ctx,
-            verbose=False,
+    def from_path(
+        cls, model_path:str, n_ctx:int|None=None, token_budget:int=16384, memory_fraction:float=0.5,
+        type_k:str='f16', type_v:str='f16', flash_attn:bool=False,
+        state_cache_bytes:int=0, state_cache_dir:str|None=None, draft_model_path:str|None=None, **kwargs
+    ) -> Self:
+        '''
+        without `n_ctx` the context holds `token_budget` tokens, and can grow up to the training
+        context or the size whose kv cache fits in `memory_fraction` of the available memory.
+        `type_k`/`type_v` quantize the kv cache (e.g. "q8_0"), a quantized v cache needs flash attention.
+        `draft_model_path` loads a smaller GGUF of the same family for speculative decoding.
+        `state_cache_bytes` keeps branched-off kv caches in memory (off by default, a state is as large
+        as the kv cache of its tokens)
+        '''
+        metadata = read_metadata(model_path)
+        shape = kv_shape(metadata)
+
+        # llama.cpp aborts when a head is not a whole number of quantization blocks (32 elements)
+        if shape and type_k not in ('f16', 'f32') and shape[2] % 32:
+            logger.warning(f"{type_k} k cache needs a head size multiple of 32 (got {shape[2]}), using f16")
+            type_k = 'f16'
+        if shape and type_v not in ('f16', 'f32') and shape[3] % 32:
+            logger.warning(f"{type_v} v cache needs a head size multiple of 32 (got {shape[3]}), using f16")
+            type_v = 'f16'
+
+        if type_v not in ('f16', 'f32') and not flash_attn:
+            logger.debug(f"flash attention enabled for the {type_v} v cache")
+            flash_attn = True
+
+        per_token = kv_bytes_per_token(shape, type_k, type_v)
+        n_ctx_train = int(metadata.get(f"{metadata.get('general.architecture')}.context_length", 0))
+
+        limit, reason = n_ctx_train or token_budget, 'the training context'
+        if per_token and (available := available_bytes()):
+            # the mapped weights take their share of the page cache first
+            memory = (available - os.path.getsize(model_path)) * memory_fraction
+            if (fits := int(memory / per_token)) < limit:
+                limit, reason = max(fits, CTX_STEP), 'the available memory'
+        limit = max(limit // CTX_STEP * CTX_STEP, CTX_STEP)
+
+        if n_ctx is None:
+            n_ctx = min(token_budget, limit)
+            if n_ctx < token_budget:
+                logger.warning(f"context of {n_ctx} tokens instead of {token_budget}, limited by {reason}")
+        else:
+            limit = n_ctx
+
+        load_kwargs = {
+            'model_path':model_path,
+            'type_k':KV_CACHE_TYPES[type_k][0],
+            'type_v':KV_CACHE_TYPES[type_v][0],
+            'flash_attn':flash_attn,
+            'verbose':False,
             **kwargs
+        }
+
+        before = memory_usage()
+        model = Llama(n_ctx=n_ctx, **load_kwargs)
+        logger.debug(
+            f"loaded {os.path.basename(model_path)} with n_ctx({n_ctx}) limit({limit}) kv({type_k}/{type_v}, "
+            f"{per_token * n_ctx / 1024**2:.0f}MiB), memory before: {before}, after: {memory_usage()}"
         )
 
-        return cls(name = os.path.basename(model_path), model=model)
+        draft = None
+        if draft_model_path:
+            draft = Llama(model_path=draft_model_path, n_ctx=model.n_ctx(), verbose=False, use_mmap=kwargs.get('use_mmap', True))
+            if draft.n_vocab() != model.n_vocab():
+                raise ValueError(f"draft model vocabulary ({draft.n_vocab()}) differs from the model's ({model.n_vocab()})")
 
-    def generate(self, prompt:str, **kwargs) -> str:
+        state_cache = PromptStateCache(state_cache_bytes, cache_dir=state_cache_dir) if state_cache_bytes else None
+
+        return cls(
+            name = os.path.basename(model_path), model=model, state_cache=state_cache, context_limit=limit, draft=draft
+        )
+
+    def grow_context(self, n_tokens:int) -> bool:
+        '''
+        re-creates the context with room for `n_tokens` (at least doubling it), False when it cannot hold them.
+        the loaded weights are kept, only the kv cache is allocated again and the evaluated prompt is lost
+        '''
+        if n_tokens <= self.n_ctx:
+            return True
+
+        if n_tokens > self.context_limit:
+            return False
+
+        n_ctx = min(max(self.n_ctx * 2, -(-n_tokens // CTX_STEP) * CTX_STEP), self.context_limit)
+
+        before = memory_usage()
+        resize_context(self.model, n_ctx)
+        if self.draft is not None:
+            resize_context(self.draft, n_ctx)
+        logger.debug(f"context grown to {n_ctx} tokens, memory before: {before}, after: {memory_usage()}")
+
+        return True
+
+    @property
+    def n_ctx(self) -> int:
+        return self.model.n_ctx()
+
+    def count_tokens(self, text:str) -> int:
+        #* only reads the vocabulary, safe to call while the worker thread decodes
+        return len(self.model.tokenize(text.encode('utf-8'), add_bos=False, special=True))
+
+    def _checkpoint(self, evaluated:list[int], reused:int):
+        if self.state_cache and len(evaluated) - reused >= self.MIN_CHECKPOINT_TOKENS:
+            self.state_cache.save(capture(self.model))
+
+    def prepare(self, prompt:str, reserve:int=0) -> list[int]:
+        '''
+        tokenize `prompt` and bring the kv cache to the longest evaluated prefix of it,
+        growing the context when the prompt and `reserve` generated tokens do not fit
+
+        llama.cpp only reuses the kv cache when the prompt extends what was evaluated last.
+        a prompt that branches off (e.g. the short tool-result prompt) would overwrite the
+        conversation, so that branch is saved first and restored when the conversation continues
+        '''
+        tokens = self.model.tokenize(prompt.encode('utf-8'), add_bos=True, special=True)
+        if not self.grow_context(len(tokens) + max(reserve or 0, 0)):
+            if len(tokens) >= self.context_limit:
+                raise ValueError(f"Prompt of {len(tokens)} tokens exceeds the context limit({self.context_limit})")
+
+            # only the reserved tokens do not fit, the answer is cut at the end of the context
+            logger.warning(f"no room for {reserve} tokens after the prompt({len(tokens)}), context limit({self.context_limit})")
+            self.grow_context(self.context_limit)
+
+        # the last prompt token is always evaluated again to get the logits
+        evaluated = self.model._input_ids.tolist()
+        reused = min(Llama.longest_token_prefix(evaluated, tokens), len(tokens) - 1)
+
+        restored = False
+        if self.state_cache:
+            self._checkpoint(evaluated, reused)
+
+            state = self.state_cache.lookup(tokens)
+            if state and len(state.tokens) <= self.n_ctx and (n := min(Llama.longest_token_prefix(state.tokens, tokens), len(tokens) - 1)) > reused:
+                restore(self.model, state)
+                reused, restored = n, True
+
+        self.last_usage = {
+            'prompt_tokens':len(tokens),
+            'reused_tokens':reused,
+            'prefilled_tokens':len(tokens) - reused,
+            'restored':int(restored),
+        }
+        logger.debug(f"prompt tokens({len(tokens)}) reused({reused}) prefilled({len(tokens) - reused}) restored({restored})")
+
+        return tokens
+
+    def _sampling_kwargs(self, kwargs:dict) -> dict:
         if 'max_tokens' not in kwargs:
             kwargs['max_tokens'] = self.max_tokens
 
-        output = self.model(prompt, **kwargs)
-        choices = output['choices']
-        response = choices[0]['text'].strip()
-        return response
\ No newline at end of file
+        #* a GBNF grammar can be given as a string
+        if isinstance(kwargs.get('grammar'), str):
+            kwargs['grammar'] = parse_grammar(kwargs['grammar']) if kwargs['grammar'] else None
+
+        return kwargs
+
+    def _draft_model(self, mode:str|None, num_draft:int):
+        if not mode:
+            return None
+
+        if mode == 'lookup':
+            return prompt_lookup(num_pred_tokens=num_draft)
+
+        if mode == 'draft':
+            if self.draft is None:
+                raise ValueError("No draft model, load one with from_path(draft_model_path=...)")
+            return GGUFDraftModel(self.draft, num_pred_tokens=num_draft)
+
+        raise ValueError(f"Unknown speculative mode({mode})")
+
+    def _prefill(self, tokens:list[int]):
+        '''evaluates the prompt up to its last token, without keeping the logits of every position'''
+        n = min(Llama.longest_token_prefix(self.model._input_ids.tolist(), tokens), len(tokens) - 1)
+        self.model.n_tokens = n
+        self.model.eval(tokens[n:-1])
+
+    def generate(self, prompt:str, **kwargs) -> str:
+        return ''.join(self.generate_stream(prompt, **kwargs)).strip()
+
+    def generate_stream(self, prompt:str, speculative:str|None=None, num_draft:int=8, **kwargs) -> Iterator[str]:
+        '''
+        `speculative`: "lookup" drafts `num_draft` tokens copied from the prompt after the latest
+        n-gram, "draft" has the draft model write them; the model checks a whole draft in one pass.
+        the accepted draft ratio and tokens/s are in `last_usage`
+        '''
+        start = time.monotonic()
+        kwargs = self._sampling_kwargs(kwargs)
+        draft = self._draft_model(speculative, num_draft)
+
+        #* prepared first, it may re-create self.model
+        tokens = self.prepare(prompt, reserve=kwargs['max_tokens'])
+        if draft:
+            self._prefill(tokens)
+
+        #* counts the sampled tokens, the text does not show them all (special tokens, partial characters)
+        first, n_sampled = None, 0
+        def count(input_ids, logits) -> bool:
+            nonlocal first, n_sampled
+            first = first or time.monotonic()
+            n_sampled += 1
+            #* llama-cpp-python decodes past max_tokens to finish a utf-8 character, never past the context
+            return len(input_ids) >= n_ctx
+
+        n_ctx = self.n_ctx
+        kwargs['stopping_criteria'] = StoppingCriteriaList([count, *(kwargs.get('stopping_criteria') or [])])
+
+        counter, completed = None, False
+        try:
+            with drafting(self.model, draft) if draft else nullcontext() as counter:
+                for chunk in self.model(tokens, stream=True, **kwargs):
+                    if delta := chunk['choices'][0]['text']:
+                        yield delta
+                completed = True
+        finally:
+            # a finished completion checks the criteria once more at the end
+            self._report(n_sampled - completed, start, first, counter)
+
+    def _report(self, n_tokens:int, start:float, first:float|None, counter):
+        elapsed = time.monotonic() - (first or start)
+
+        usage = {
+            'completion_tokens':n_tokens,
+            'first_token_sec':round((first or start) - start, 3),
+            'tokens_per_sec':round((n_tokens - 1) / elapsed, 2) if n_tokens > 1 and elapsed > 0 else 0.0,
+        }
+        if counter is not None:
+            usage.update({
+                'draft_proposed':counter.proposed,
+                'draft_accepted':counter.accepted,
+                'accept_ratio':round(counter.accept_ratio, 4),
+            })
+
+        self.last_usage.update(usage)
+        logger.debug(f"generation {' '.join(f'{k}({v})' for k, v in usage.items())}")
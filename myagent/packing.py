@@ -0,0 +1,178 @@
+from typing import Callable
+import math
+import re
+
+from .utils import tokenize
+
+#* paragraphs and markdown headings start a new piece of a tool output
+BREAK_PATTERN = re.compile(r'\n\s*\n|\n(?=#{1,6} )')
+
+GAP = '[...]'
+
+
+class Chunk:
+    def __init__(self, result:int, output:int, index:int, text:str, n_tokens:int) -> None:
+        self.result:int = result      # position of the tool call
+        self.output:int = output      # position of the content in its output
+        self.index:int = index        # position of the chunk in its content
+        self.text:str = text
+        self.n_tokens:int = n_tokens
+        self.score:float = 0.0
+
+
+class ContextPacker:
+    '''
+    fits tool results into `token_budget` tokens before they are put into the prompt
+
+    the outputs are split into chunks of about `chunk_tokens` tokens along paragraphs and headings,
+    ranked by BM25 against the question (the chunks of this turn are the corpus) and the best ones
+    are kept, in their original order, with `[...]` where something was left out.
+    errors and results that already fit are passed through untouched.
+    '''
+    def __init__(self, count_tokens:Callable[[str], int], token_budget:int=2048, chunk_tokens:int=256, k1:float=1.2, b:float=0.75) -> None:
+        self.count_tokens:Callable[[str], int] = count_tokens
+        self.token_budget:int = token_budget
+        self.chunk_tokens:int = chunk_tokens
+
+        self.k1:float = k1
+        self.b:float = b
+
+    def _split(self, text:str) -> list[str]:
+        '''consecutive paragraphs merged up to `chunk_tokens`, an oversized paragraph is cut by lines'''
+        pieces = []
+        for part in BREAK_PATTERN.split(text):
+            if not part.strip():
+                continue
+
+            if self.count_tokens(part) <= self.chunk_tokens:
+                pieces.append(part.strip('\n'))
+                continue
+
+            # a rough character limit, one token is ~4 characters
+            limit = self.chunk_tokens * 4
+            line_chunk = ''
+            for line in part.splitlines(keepends=True):
+                while len(line) > limit:
+                    if line_chunk.strip():
+                        pieces.append(line_chunk.rstrip())
+                    line_chunk = ''
+
+                    cut = line.rfind(' ', 0, limit) + 1 or limit
+                    pieces.append(line[:cut].rstrip())
+                    line = line[cut:]
+
+                if line_chunk.strip() and len(line_chunk) + len(line) > limit:
+                    pieces.append(line_chunk.rstrip())
+                    line_chunk = ''
+                line_chunk += line
+
+            if line_chunk.strip():
+                pieces.append(line_chunk.rstrip())
+
+        chunks, current = [], ''
+        for piece in pieces:
+            merged = f"{current}\n\n{piece}" if current else piece
+            if current and self.count_tokens(merged) > self.chunk_tokens:
+                chunks.append(current)
+                merged = piece
+            current = merged
+
+        if current:
+            chunks.append(current)
+
+        return chunks
+
+    def _score(self, chunks:list[Chunk], question:str):
+        terms = set(tokenize(question))
+        if not terms:
+            return
+
+        docs = [tokenize(c.text) for c in chunks]
+        avg_len = sum(len(d) for d in docs) / len(docs) or 1.0
+
+        df = dict.fromkeys(terms, 0)
+        for d in docs:
+            for t in terms.intersection(d):
+                df[t] += 1
+
+        n = len(docs)
+        idf = {t:math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5)) for t in terms}
+
+        for chunk, d in zip(chunks, docs):
+            tf:dict[str, int] = {}
+            for t in d:
+                if t in terms:
+                    tf[t] = tf.get(t, 0) + 1
+
+            norm = self.k1 * (1 - self.b + self.b * len(d) / avg_len)
+            chunk.score = sum(idf[t] * f * (self.k1 + 1) / (f + norm) for t, f in tf.items()) + 0.0
+
+    def pack(self, results:list[dict], question:str) -> tuple[list[dict], list[dict]]:
+        '''
+        (packed results, dropped chunks) for the results of `Agent.get_result_tool`.
+        a dropped chunk is reported as {name, output, chunk, tokens, score, preview}
+        '''
+        chunks:list[Chunk] = []
+        contents:dict[tuple[int, int], list[Chunk]] = {}
+        for i, result in enumerate(results):
+            for j, content in enumerate(result.get('output', [])):
+                parts = contents[i, j] = []
+                for k, text in enumerate(self._split(content)):
+                    parts.append(Chunk(i, j, k, text, self.count_tokens(text)))
+                chunks += parts
+
+        total = sum(c.n_tokens for c in chunks)
+        if total <= self.token_budget:
+            return results, []
+
+        self._score(chunks, question)
+
+        # best first, earlier chunks win ties (a note starts with its title and summary)
+        ranked = sorted(chunks, key=lambda c:(-c.score, c.index, c.result, c.output))
+
+        used, kept, dropped = 0, set(), []
+        for c in ranked:
+            if used + c.n_tokens <= self.token_budget:
+                used += c.n_tokens
+                kept.add(id(c))
+            else:
+                dropped.append(c)
+
+        packed = []
+        for i, result in enumerate(results):
+            if 'output' not in result:
+                packed.append(result)
+                continue
+
+            outputs = []
+            for j in range(len(result['output'])):
+                parts = contents[i, j]
+                if not any(id(c) in kept for c in parts):
+                    continue
+
+                # a run of dropped chunks is left as one marker
+                pieces = []
+                for c in parts:
+                    if id(c) in kept:
+                        pieces.append(c.text)
+                    elif not pieces or pieces[-1] != GAP:
+                        pieces.append(GAP)
+
+                outputs.append('\n\n'.join(pieces))
+
+            packed.append({**result, 'output':outputs})
+
+        dropped.sort(key=lambda c:(c.result, c.output, c.index))
+        report = [
+            {
+                'name':results[c.result]['name'],
+                'output':c.output,
+                'chunk':c.index,
+                'tokens':c.n_tokens,
+                'score':round(c.score, 3),
+                'preview':' '.join(c.text[:80].split()),
+            }
+            for c in dropped
+        ]
+
+        return packed, report
@@ -0,0 +1,94 @@
+from typing import Any
+import json
+import logging
+import os
+
+from .utils import tokenize
+
+logger = logging.getLogger('agent.prefetch')
+
+#* answers from prefetched notes skip the model's own tool choice, so the launchers only prefetch on request
+PREFETCH_DOCS = os.environ.get('PREFETCH_DOCS', '') == '1'
+
+
+class RetrievalPrefetch:
+    '''
+    reads the notes a question obviously refers to before the model runs, saving the
+    tool-selection generation
+
+    the question is searched with `search_tool` (name, uri and score per hit). the hits are used when
+    the question names a note (all the words of its name appear in the question), or when the
+    best hit scores at least `min_score` and `min_margin` times the second one. they are read with
+    `read_tool` and given to the model as tool results; otherwise the model picks the tools as usual
+    '''
+    def __init__(
+        self, search_tool:str='search_docs', read_tool:str='get_doc_by_uri', k:int=5,
+        max_docs:int=2, min_score:float=4.0, min_margin:float=1.5
+    ) -> None:
+        self.search_tool:str = search_tool
+        self.read_tool:str = read_tool
+        self.k:int = k
+
+        self.max_docs:int = max_docs
+        self.min_score:float = min_score
+        self.min_margin:float = min_margin
+
+        self.prefetched:int = 0
+        self.fallbacks:int = 0
+
+    def search_args(self, question:str) -> dict[str, Any]:
+        return {'query':question, 'k':self.k}
+
+    @staticmethod
+    def parse_hits(contents:list[str]) -> list[dict]:
+        '''hits of the search result, one json object per content or a json list'''
+        hits = []
+        for text in contents:
+            try:
+                value = json.loads(text)
+            except ValueError:
+                continue
+
+            hits += value if isinstance(value, list) else [value]
+
+        return [h for h in hits if isinstance(h, dict) and 'uri' in h]
+
+    def select(self, question:str, hits:list[dict]) -> tuple[list[str], str]:
+        '''(uris to read, why), no uris when the match is not clear'''
+        words = set(tokenize(question))
+
+        named = []
+        for hit in hits:
+            name = tokenize(hit.get('name', ''))
+            # a note named by a short word only would match almost any question
+            if name and set(name) <= words and max(len(w) for w in name) > 2:
+                named.append(hit['uri'])
+
+        if named:
+            return named[:self.max_docs], 'name'
+
+        scores = [float(h.get('score', 0)) for h in hits]
+        if scores and scores[0] >= self.min_score and (len(scores) == 1 or scores[0] >= scores[1] * self.min_margin):
+            return [hits[0]['uri']], 'score'
+
+        return [], 'low confidence'
+
+    def tool_call(self, uris:list[str]) -> str:
+        '''the calls reading `uris`, written the way the model would'''
+        return '[' + ', '.join(f"{self.read_tool}(uri={json.dumps(uri, ensure_ascii=False)})" for uri in uris) + ']'
+
+    def record(self, prefetched:bool, reason:str):
+        if prefetched:
+            self.prefetched += 1
+        else:
+            self.fallbacks += 1
+
+        logger.debug(f"{'prefetched' if prefetched else 'fell back to tool calling'} ({reason}), prefetched {self.prefetched} / fell back {self.fallbacks}")
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.prefetched + self.fallbacks
+        return {
+            'prefetched':self.prefetched,
+            'fallbacks':self.fallbacks,
+            'prefetch_rate':round(self.prefetched / total, 4) if total else 0.0,
+        }
@@ -1,27 +1,42 @@
-from typing import Optional, Any
+from typing import Optional, Any, Callable
+from collections import deque
 from .types import BasePrompt, BaseMessage
 import json
 
+def estimate_tokens(text:str) -> int:
+    '''rough token count (~4 characters per token) until the model's tokenizer is set'''
+    return len(text) // 4 + 1
+
 class History:
-    def __init__(self, max_history:int=50) -> None:
-        self._history:list[BaseMessage] = []
+    def __init__(self, max_history:int=1000) -> None:
+        # (sequence number, message), the oldest messages fall off the left in O(1)
+        self._history:deque[tuple[int, BaseMessage]] = deque(maxlen=max_history)
         self._max_history:int = max_history
+        self._seq:int = 0
 
     def append_message(self, msg:BaseMessage):
-        self._history.append(msg)
-        self._history = self._history[-self._max_history:]
+        self._history.append((self._seq, msg))
+        self._seq += 1
+
+    def get_chat_history(self, last:int=0, since:int=0) -> list[BaseMessage]:
+        '''the `last` messages (all when 0) appended at or after sequence number `since`'''
+        return [msg for _, msg in self.get_numbered_history(last=last, since=since)]
 
-    def get_chat_history(self, last:int=0) -> list[BaseMessage]:
+    def get_numbered_history(self, last:int=0, since:int=0) -> list[tuple[int, BaseMessage]]:
         if last < 0:
             return []
-        
-        if last > 0:
-            return self._history[-last:]
-        
-        return self._history
-    
+
+        history = []
+        for seq, msg in reversed(self._history):
+            if seq < since or (last and len(history) == last):
+                break
+            history.append((seq, msg))
+
+        history.reverse()
+        return history
+
     def clear(self):
-        self._history = []
+        self._history.clear()
 
 class LLamaMessage(BaseMessage):
     def __init__(self, role:str, content:str='', tool_scheme:str=''):
@@ -29,31 +44,65 @@ class LLamaMessage(BaseMessage):
         self.content:str = content
         self.tool_scheme:str = tool_scheme
 
+        #* messages are not modified once created, so the rendering and its token count are cached
+        self._templates:dict[bool, str] = {}
+        self._n_tokens:dict[bool, int] = {}
+
     def template(self, tool_enabled:bool=False) -> str:
+        tool_enabled = bool(tool_enabled and self.tool_scheme)
+        if (prompt := self._templates.get(tool_enabled)) is not None:
+            return prompt
+
         #* Llama CPP insert BOS token internally
         prompt = f"<|start_header_id|>{self.role}<|end_header_id|>"
 
-        if tool_enabled and self.tool_scheme:
+        if tool_enabled:
             prompt += f"{self.tool_scheme}"
 
         if self.content:
             prompt += f"{self.content}<|eot_id|>"
 
+        self._templates[tool_enabled] = prompt
         return prompt
 
+    def n_tokens(self, count_tokens:Callable[[str], int], tool_enabled:bool=False) -> int:
+        tool_enabled = bool(tool_enabled and self.tool_scheme)
+        if (n := self._n_tokens.get(tool_enabled)) is None:
+            n = self._n_tokens[tool_enabled] = count_tokens(self.template(tool_enabled=tool_enabled))
+
+        return n
+
 class LlamaPrompt(BasePrompt):
     ROLE_SYSTEM = 'system'
     ROLE_USER = 'user'
     ROLE_ASSISTANT = 'assistant'
     ROLE_TOOL = 'ipython'
 
-    def __init__(self) -> None:
+    #* when the history outgrows the budget it is cut down to this share of it, so the prompt
+    #* prefix (and the model's kv cache of it) stays the same for several turns
+    SHRINK_RATIO = 0.75
+
+    def __init__(self, token_budget:int=8192) -> None:
         self.system_prompt:BaseMessage = LLamaMessage('system', "You are a helpful assistant.")
         self.history:History = History()
 
+        self.count_tokens:Callable[[str], int] = estimate_tokens
+        self.token_budget:int = token_budget
+
+        # history before this sequence number no longer fits in the prompt
+        self._window_start:int = 0
+
+    def set_token_budget(self, count_tokens:Callable[[str], int], token_budget:int):
+        '''count tokens with the model's tokenizer and keep prompts within `token_budget` tokens'''
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+
+        for msg in [self.system_prompt] + self.history.get_chat_history():
+            msg._n_tokens.clear()
+
     def append_history(self, message:LLamaMessage):
         self.history.append_message(message)
-    
+
     def set_system_prompt(self, system_prompt:LLamaMessage):
         self.system_prompt = system_prompt
 
@@ -65,13 +114,39 @@ class LlamaPrompt(BasePrompt):
 
     def get_assistant_prompt(self, answer:Optional[str]="") -> LLamaMessage:
         return LLamaMessage(LlamaPrompt.ROLE_ASSISTANT, answer)
-    
+
     def get_tool_result_prompt(self, result:str) -> LLamaMessage:
         return LLamaMessage(LlamaPrompt.ROLE_TOOL, result)
-    
-    def get_generation_prompt(self, tool_enabled:bool=False, last:int=50) -> str:
+
+    def _fit(self, history:list[tuple[int, BaseMessage]], budget:int, tool_enabled:bool) -> list[BaseMessage]:
+        '''the newest messages within `budget` tokens (the newest one is always kept)'''
+        sizes = [msg.n_tokens(self.count_tokens, tool_enabled=tool_enabled) for _, msg in history]
+
+        total = sum(sizes)
+        if total > budget:
+            target = int(budget * self.SHRINK_RATIO)
+
+            drop = 0
+            while drop < len(history) - 1 and total > target:
+                total -= sizes[drop]
+                drop += 1
+
+            history = history[drop:]
+            self._window_start = max(self._window_start, history[0][0])
+
+        return [msg for _, msg in history]
+
+    def get_generation_prompt(self, tool_enabled:bool=False, last:int=0) -> str:
+        generation_prompt = self.get_assistant_prompt(answer='') #* generation prompt
+
+        budget = self.token_budget
+        budget -= self.system_prompt.n_tokens(self.count_tokens, tool_enabled=tool_enabled)
+        budget -= generation_prompt.n_tokens(self.count_tokens)
+
+        history = self.history.get_numbered_history(last=last, since=self._window_start)
+
         prompt = [self.system_prompt]
-        prompt += self.history.get_chat_history(last=last)
-        prompt += [self.get_assistant_prompt(answer='')] #* generation prompt
-        
-        return ''.join([p.template(tool_enabled=tool_enabled) for p in prompt])
\ No newline at end of file
+        prompt += self._fit(history, budget, tool_enabled) if history else []
+        prompt += [generation_prompt]
+
+        return ''.join([p.template(tool_enabled=tool_enabled) for p in prompt])
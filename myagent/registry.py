@@ -0,0 +1,166 @@
+from typing import Callable
+from collections import OrderedDict
+from concurrent.futures import Future
+import logging
+import os
+import threading
+import time
+
+from .model import LlamaCPP
+from .utils import rss_bytes
+
+logger = logging.getLogger('agent.registry')
+
+
+class ModelEntry:
+    def __init__(self, key:tuple[str, str], path:str) -> None:
+        self.key:tuple[str, str] = key
+        self.path:str = path
+        self.future:Future[LlamaCPP] = Future()
+
+        self.load_time:float = 0.0
+        self.file_bytes:int = os.path.getsize(path)
+        self.rss_bytes:int = 0  # resident memory the load added (kv cache, buffers, touched weights)
+        self.last_used:float = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        '''memory charged against the cap: the mapped weights and what the load made resident'''
+        return self.file_bytes + self.rss_bytes
+
+
+class ModelRegistry:
+    '''
+    loads each GGUF once per process and shares the instance between sessions and agents
+
+    models are keyed by their real path and load options, and mapped (use_mmap) so the weights
+    live in the page cache instead of the heap. the least recently used models are dropped when
+    the loaded ones exceed `max_bytes`; a dropped model is freed once its last user lets it go.
+    `warm_up` loads a model (and touches its weights) on a background thread
+    '''
+    def __init__(self, max_bytes:int=0, **defaults) -> None:
+        self.max_bytes:int = max_bytes
+        self.defaults:dict = {'use_mmap':True, **defaults}
+
+        self._entries:OrderedDict[tuple[str, str], ModelEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+        # called with the path of every evicted model
+        self.on_evict:list[Callable[[str], None]] = []
+
+    def _key(self, model_path:str, kwargs:dict) -> tuple[str, str]:
+        return os.path.realpath(model_path), repr(sorted(kwargs.items()))
+
+    def get(self, model_path:str, **kwargs) -> LlamaCPP:
+        '''the loaded model, loading it on the calling thread unless it is (being) loaded already'''
+        entry, owner = self._entry(model_path, {**self.defaults, **kwargs})
+        if owner:
+            self._load(entry, {**self.defaults, **kwargs})
+
+        model = entry.future.result()
+        entry.last_used = time.monotonic()
+
+        return model
+
+    def warm_up(self, model_path:str, **kwargs) -> Future[LlamaCPP]:
+        '''starts loading a model in the background, `get` waits for it'''
+        kwargs = {**self.defaults, **kwargs}
+        entry, owner = self._entry(model_path, kwargs)
+
+        if owner:
+            threading.Thread(target=self._load, args=(entry, kwargs, True), name='model-warm-up', daemon=True).start()
+
+        return entry.future
+
+    def _entry(self, model_path:str, kwargs:dict) -> tuple[ModelEntry, bool]:
+        key = self._key(model_path, kwargs)
+
+        with self._lock:
+            if entry := self._entries.get(key):
+                self._entries.move_to_end(key)
+                return entry, False
+
+            entry = self._entries[key] = ModelEntry(key, key[0])
+            return entry, True
+
+    def _load(self, entry:ModelEntry, kwargs:dict, touch:bool=False):
+        before, start = rss_bytes(), time.monotonic()
+
+        try:
+            model = LlamaCPP.from_path(entry.path, **kwargs)
+
+            if touch:
+                # one forward pass reads every layer, so the first question does not page the weights in
+                model.model.eval([model.model.token_bos()])
+                model.model.reset()
+        except Exception as e:
+            with self._lock:
+                self._entries.pop(entry.key, None)
+            entry.future.set_exception(e)
+            logger.warning(f"failed to load {entry.path} ({e!r})")
+            return
+
+        entry.load_time = time.monotonic() - start
+        entry.rss_bytes = max(rss_bytes() - before, 0)
+        logger.debug(f"loaded {model.name} in {entry.load_time:.2f}s, file {entry.file_bytes / 1024**2:.0f}MiB, resident +{entry.rss_bytes / 1024**2:.0f}MiB")
+
+        entry.future.set_result(model)
+        self._shrink(keep=entry)
+
+    def _shrink(self, keep:ModelEntry):
+        if not self.max_bytes:
+            return
+
+        evicted = []
+        with self._lock:
+            total = sum(e.nbytes for e in self._entries.values() if e.future.done())
+            for key, entry in list(self._entries.items()):
+                if total <= self.max_bytes:
+                    break
+
+                if entry is keep or not entry.future.done():
+                    continue
+
+                del self._entries[key]
+                total -= entry.nbytes
+                evicted.append(entry)
+
+        for entry in evicted:
+            self._evicted(entry)
+
+    def _evicted(self, entry:ModelEntry):
+        logger.debug(f"evicted {os.path.basename(entry.path)} ({entry.nbytes / 1024**2:.0f}MiB)")
+        for callback in self.on_evict:
+            callback(entry.path)
+
+    def evict(self, model_path:str) -> bool:
+        '''drops every loaded variant of a model'''
+        path = os.path.realpath(model_path)
+        with self._lock:
+            evicted = [self._entries.pop(key) for key in list(self._entries) if key[0] == path]
+
+        for entry in evicted:
+            self._evicted(entry)
+
+        return bool(evicted)
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            entries = list(self._entries.values())
+
+        now = time.monotonic()
+        return [
+            {
+                'name':os.path.basename(e.path),
+                'loaded':e.future.done() and e.future.exception() is None,
+                'load_time':round(e.load_time, 3),
+                'file_bytes':e.file_bytes,
+                'rss_bytes':e.rss_bytes,
+                'idle':round(now - e.last_used, 1),
+            }
+            for e in entries
+        ]
+
+
+#* the registry of this process
+registry = ModelRegistry()
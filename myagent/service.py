@@ -0,0 +1,150 @@
+from typing import AsyncGenerator, Callable
+import logging
+import time
+import uuid
+
+from .agent import Agent
+from .prompt import LlamaPrompt
+from .types import AgentResponse, BasePrompt
+from . import errors
+
+logger = logging.getLogger('agent.service')
+
+
+class AgentSession:
+    def __init__(self, session_id:str, agent:Agent) -> None:
+        self.id:str = session_id
+        self.agent:Agent = agent
+
+        self.created:float = time.monotonic()
+        self.last_active:float = self.created
+        self.turns:int = 0
+        self.busy:bool = False
+
+
+class AgentService:
+    '''
+    serves many chat sessions with one loaded model and one set of MCP clients
+
+    every session is a fork of `agent` with its own history. their generations are scheduled
+    round robin by the shared worker, and the kv cache of a session's conversation is saved in the
+    model's state cache when another session takes over the model, then restored on its next turn.
+
+    admission: at most `max_sessions` open sessions (idle ones expire after `session_ttl` seconds),
+    one turn at a time per session and at most `max_active` turns in progress, otherwise ServiceBusy
+    '''
+    def __init__(
+        self, agent:Agent, prompt_factory:Callable[[], BasePrompt]=LlamaPrompt,
+        max_sessions:int=16, max_active:int=8, session_ttl:float=3600.0
+    ) -> None:
+        self.agent:Agent = agent
+        self.prompt_factory:Callable[[], BasePrompt] = prompt_factory
+
+        self.max_sessions:int = max_sessions
+        self.max_active:int = max_active
+        self.session_ttl:float = session_ttl
+
+        #* every active turn has at most one generation waiting, so submitting never blocks
+        self.agent.worker.max_queue = max_active
+
+        self.sessions:dict[str, AgentSession] = {}
+        self.active:int = 0
+
+        self.turns:int = 0
+        self.rejected:int = 0
+        self.turn_time:float = 0.0
+
+    async def start(self):
+        await self.agent.init_agent()
+
+    async def close(self):
+        self.agent.cancel_all()
+        await self.agent.clean_agent()
+        self.sessions.clear()
+
+    async def __aenter__(self):
+        await self.start()
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def _expire(self):
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            if not session.busy and now - session.last_active > self.session_ttl:
+                logger.debug(f"session({session.id}) expired after {session.turns} turns")
+                del self.sessions[session.id]
+
+    def open_session(self, session_id:str|None=None) -> str:
+        self._expire()
+
+        session_id = session_id or uuid.uuid4().hex
+        if session_id in self.sessions:
+            return session_id
+
+        if len(self.sessions) >= self.max_sessions:
+            self.rejected += 1
+            raise errors.ServiceBusy(f"too many sessions ({self.max_sessions})")
+
+        self.sessions[session_id] = AgentSession(session_id, self.agent.fork(self.prompt_factory(), session_id))
+        logger.debug(f"session({session_id}) opened, {len(self.sessions)} sessions")
+
+        return session_id
+
+    def close_session(self, session_id:str):
+        if session := self.sessions.pop(session_id, None):
+            session.agent.cancel()
+
+    def cancel(self, session_id:str):
+        if session := self.sessions.get(session_id):
+            session.agent.cancel()
+
+    def _session(self, session_id:str) -> AgentSession:
+        if (session := self.sessions.get(session_id)) is None:
+            raise errors.AgentException(f"No session({session_id})")
+
+        return session
+
+    async def chat_stream(self, session_id:str, question:str, **kwargs) -> AsyncGenerator[AgentResponse, None]:
+        session = self._session(session_id)
+
+        if session.busy:
+            self.rejected += 1
+            raise errors.ServiceBusy(f"session({session_id}) already has a turn in progress")
+
+        if self.active >= self.max_active:
+            self.rejected += 1
+            raise errors.ServiceBusy(f"too many turns in progress ({self.max_active})")
+
+        session.busy = True
+        self.active += 1
+        start = time.monotonic()
+
+        try:
+            async for response in session.agent.chat_stream(question, **kwargs):
+                yield response
+        finally:
+            session.busy = False
+            self.active -= 1
+
+            session.turns += 1
+            session.last_active = time.monotonic()
+
+            self.turns += 1
+            self.turn_time += session.last_active - start
+
+    async def chat(self, session_id:str, question:str, **kwargs) -> list[AgentResponse]:
+        return [r async for r in self.chat_stream(session_id, question, **kwargs) if not r.partial]
+
+    def stats(self) -> dict:
+        return {
+            'sessions':len(self.sessions),
+            'active_turns':self.active,
+            'queued_generations':self.agent.worker.queued,
+            'turns':self.turns,
+            'rejected':self.rejected,
+            'avg_turn_time':round(self.turn_time / self.turns, 4) if self.turns else 0.0,
+            'worker':self.agent.worker.stats.snapshot(),
+        }
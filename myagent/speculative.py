@@ -0,0 +1,91 @@
+from contextlib import contextmanager
+from typing import Iterator
+import numpy as np
+import numpy.typing as npt
+
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    '''greedy drafts of a small model sharing the vocabulary of the target model'''
+    def __init__(self, model:Llama, num_pred_tokens:int=8) -> None:
+        self.model:Llama = model
+        self.num_pred_tokens:int = num_pred_tokens
+
+    def __call__(self, input_ids:npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        if len(input_ids) + self.num_pred_tokens > self.model.n_ctx():
+            return np.array([], dtype=np.intc)
+
+        # Llama.generate only evaluates what follows the prefix the draft model has already seen
+        draft = []
+        for token in self.model.generate(input_ids.tolist(), top_k=1, temp=0.0):
+            draft.append(token)
+            if len(draft) == self.num_pred_tokens:
+                break
+
+        return np.array(draft, dtype=np.intc)
+
+
+class DraftCounter(LlamaDraftModel):
+    '''
+    counts the proposed and accepted draft tokens of a draft model
+
+    between two calls the target model kept one sampled token plus the accepted part of the
+    previous draft, so the accepted count is the growth of the input minus one.
+    the draft of the last step is not counted, the generation ends before the next call
+    '''
+    def __init__(self, draft:LlamaDraftModel) -> None:
+        self.draft:LlamaDraftModel = draft
+
+        self.proposed:int = 0
+        self.accepted:int = 0
+        self.counted:int = 0
+
+        self._last_len:int = 0
+        self._last_draft:int = 0
+
+    def __call__(self, input_ids:npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        if self._last_len:
+            self.accepted += max(min(len(input_ids) - self._last_len - 1, self._last_draft), 0)
+            self.counted += self._last_draft
+
+        draft = self.draft(input_ids, **kwargs)
+
+        self.proposed += len(draft)
+        self._last_len, self._last_draft = len(input_ids), len(draft)
+
+        return draft
+
+    @property
+    def accept_ratio(self) -> float:
+        return self.accepted / self.counted if self.counted else 0.0
+
+
+@contextmanager
+def drafting(model:Llama, draft:LlamaDraftModel) -> Iterator[DraftCounter]:
+    '''
+    drafts tokens with `draft` during the generations of `model` within the block
+
+    llama-cpp-python verifies drafts with the logits of every position (`logits_all`), and also
+    copies them into an (n_ctx x n_vocab) array. sampling reads the logits from the context, so
+    that copy is sent to a zero-stride sink instead of costing gigabytes for a large vocabulary.
+    the prompt should already be evaluated up to its last token, or its logits are all computed
+    '''
+    counter = DraftCounter(draft)
+
+    row = np.zeros(model.n_vocab(), dtype=np.single)
+    sink = np.lib.stride_tricks.as_strided(row, shape=(model.n_ctx(), model.n_vocab()), strides=(0, row.itemsize))
+
+    scores, logits_all = model.scores, model.context_params.logits_all
+    model.draft_model, model.scores, model.context_params.logits_all = counter, sink, True
+
+    try:
+        yield counter
+    finally:
+        model.draft_model, model.scores, model.context_params.logits_all = None, scores, logits_all
+
+
+def prompt_lookup(num_pred_tokens:int=10, max_ngram_size:int=2) -> LlamaDraftModel:
+    '''drafts copied from the prompt after the latest n-gram, for answers quoting the tool results'''
+    return LlamaPromptLookupDecoding(max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens)
@@ -0,0 +1,202 @@
+from typing import NamedTuple
+from collections import OrderedDict
+from array import array
+import ctypes
+import hashlib
+import logging
+import os
+import pickle
+
+import llama_cpp
+from llama_cpp import Llama
+
+logger = logging.getLogger('agent.state')
+
+
+class PromptState(NamedTuple):
+    tokens: array  # evaluated tokens ('i')
+    data: bytearray  # llama context state (kv cache of the evaluated tokens)
+
+
+def capture(model:Llama) -> PromptState:
+    '''
+    kv cache of the evaluated tokens. unlike `Llama.save_state` the logits are not copied,
+    they are (n_batch x n_vocab) floats and are recomputed by the next eval anyway
+    '''
+    ctx = model._ctx.ctx
+    size = llama_cpp.llama_state_get_size(ctx)
+
+    # llama.cpp writes straight into the bytearray kept by the state, the kv cache is copied once
+    data = bytearray(size)
+    buffer = (ctypes.c_uint8 * size).from_buffer(data)
+    n_bytes = llama_cpp.llama_state_get_data(ctx, buffer, size)
+
+    # the bytearray cannot be resized while ctypes shares it
+    del buffer
+    del data[n_bytes:]
+
+    return PromptState(array('i', model.input_ids[:model.n_tokens].tolist()), data)
+
+
+def restore(model:Llama, state:PromptState):
+    ctx = model._ctx.ctx
+    # states pickled by older versions hold bytes, which ctypes cannot share
+    data = state.data if isinstance(state.data, bytearray) else bytearray(state.data)
+    buffer = (ctypes.c_uint8 * len(data)).from_buffer(data)
+    if llama_cpp.llama_state_set_data(ctx, buffer, len(data)) != len(data):
+        raise RuntimeError("Failed to set llama state data")
+
+    n_tokens = len(state.tokens)
+    model.input_ids[:n_tokens] = state.tokens
+    model.n_tokens = n_tokens
+
+
+def _block_hashes(tokens:array, block:int):
+    '''(prefix length, hash of the prefix) at every `block` tokens'''
+    h = hashlib.blake2b(digest_size=16)
+    for end in range(block, len(tokens) + 1, block):
+        h.update(tokens[end - block:end].tobytes())
+        yield end, h.copy().digest()
+
+
+class PromptStateCache:
+    '''
+    saved llama states looked up by the longest shared token prefix
+
+    every state is registered under the hash of each BLOCK-token prefix of its tokens, so a lookup
+    is one pass of rolling hashes over the prompt. states are kept in memory within `max_bytes`
+    (LRU); with a `cache_dir` they are also written to disk and survive restarts.
+    a state file starts with the pickled tokens, so the index is rebuilt without reading the kv data
+    '''
+    BLOCK = 64
+
+    def __init__(self, max_bytes:int, cache_dir:str|None=None, max_disk_bytes:int=0) -> None:
+        self.max_bytes:int = max_bytes
+        self.cache_dir:str|None = cache_dir
+        self.max_disk_bytes:int = max_disk_bytes or max_bytes * 4
+
+        # state key -> (tokens, size of the state) of every known state, in LRU order
+        self._entries:OrderedDict[str, tuple[array, int]] = OrderedDict()
+        self._memory:OrderedDict[str, bytes] = OrderedDict()
+        # prefix hash -> keys of the states starting with that prefix, the latest saved last
+        self._blocks:dict[bytes, dict[str, None]] = {}
+
+        self.nbytes:int = 0
+        self.disk_bytes:int = 0
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_dir()
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.state")
+
+    def _load_dir(self):
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.state'):
+                st = entry.stat()
+                files.append((st.st_mtime_ns, entry.name[:-len('.state')], st.st_size))
+
+        for _, key, size in sorted(files):
+            try:
+                with open(self._path(key), 'rb') as fd:
+                    tokens = pickle.load(fd)
+            except Exception:
+                logger.warning(f"broken prompt state file({key}), removed")
+                os.remove(self._path(key))
+                continue
+
+            self._register(key, tokens, size)
+            self.disk_bytes += size
+
+    def _register(self, key:str, tokens:array, size:int):
+        self._entries[key] = (tokens, size)
+        for _, h in _block_hashes(tokens, self.BLOCK):
+            self._blocks.setdefault(h, {})[key] = None
+
+    def _forget(self, key:str):
+        tokens, size = self._entries.pop(key)
+        # a prefix shared with other states (the system prompt) stays reachable through them
+        for _, h in _block_hashes(tokens, self.BLOCK):
+            owners = self._blocks[h]
+            del owners[key]
+            if not owners:
+                del self._blocks[h]
+
+        if self.cache_dir:
+            os.remove(self._path(key))
+            self.disk_bytes -= size
+
+    def lookup(self, tokens:list[int]) -> PromptState | None:
+        '''the saved state sharing the longest (at least BLOCK tokens) prefix with `tokens`'''
+        key = None
+        for _, h in _block_hashes(array('i', tokens), self.BLOCK):
+            if (owners := self._blocks.get(h)) is None:
+                break
+            key = next(reversed(owners))
+
+        if key is None:
+            return None
+
+        self._entries.move_to_end(key)
+
+        if (data := self._memory.get(key)) is not None:
+            self._memory.move_to_end(key)
+            return PromptState(self._entries[key][0], data)
+
+        with open(self._path(key), 'rb') as fd:
+            state_tokens = pickle.load(fd)
+            data = pickle.load(fd)
+
+        self._keep(key, data)
+        return PromptState(state_tokens, data)
+
+    def save(self, state:PromptState):
+        if len(state.tokens) < self.BLOCK:
+            return
+
+        key = hashlib.blake2b(state.tokens.tobytes(), digest_size=16).hexdigest()
+        if key in self._entries:
+            # both LRU orders are kept in step, the next eviction must not take this state
+            self._entries.move_to_end(key)
+            if key in self._memory:
+                self._memory.move_to_end(key)
+            return
+
+        size = len(state.data)
+        if self.cache_dir:
+            tmp_path = f"{self._path(key)}.tmp"
+            with open(tmp_path, 'wb') as fd:
+                pickle.dump(state.tokens, fd)
+                pickle.dump(state.data, fd)
+            os.replace(tmp_path, self._path(key))
+
+            size = os.path.getsize(self._path(key))
+            self.disk_bytes += size
+
+        self._register(key, state.tokens, size)
+        self._keep(key, state.data)
+
+        # without a directory a state only lives in memory
+        while self._entries and (self.disk_bytes > self.max_disk_bytes if self.cache_dir else len(self._entries) > len(self._memory)):
+            oldest = next(iter(self._entries))
+            if (data := self._memory.pop(oldest, None)) is not None:
+                self.nbytes -= len(data)
+            self._forget(oldest)
+
+    def _keep(self, key:str, data:bytes):
+        self._memory[key] = data
+        self.nbytes += len(data)
+
+        while self.nbytes > self.max_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self.nbytes -= len(evicted)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'states':len(self._entries),
+            'in_memory':len(self._memory),
+            'bytes':self.nbytes,
+            'disk_bytes':self.disk_bytes,
+        }
@@ -0,0 +1,213 @@
+from typing import Any
+
+MAX_DEPTH = 32
+
+ESCAPES = {'n':'\n', 't':'\t', 'r':'\r', 'b':'\b', 'f':'\f', '0':'\0', '\\':'\\', '"':'"', "'":"'", '/':'/'}
+LITERALS = {'true':True, 'True':True, 'false':False, 'False':False, 'null':None, 'None':None}
+
+
+class ToolCallSyntaxError(ValueError):
+    def __init__(self, message:str, pos:int) -> None:
+        super().__init__(f"{message} at {pos}")
+        self.pos:int = pos
+
+
+def _is_ident_char(c:str) -> bool:
+    return c.isalnum() or c == '_'
+
+
+class _Parser:
+    '''
+    single pass recursive descent over `[f(a="x", b=[1, 2]), g()]`
+
+    every character is looked at a bounded number of times, so parsing is linear in the length
+    of the text whatever the model produced (nesting is limited to MAX_DEPTH)
+    '''
+    def __init__(self, text:str) -> None:
+        self.text:str = text
+        self.pos:int = 0
+
+    def error(self, message:str):
+        raise ToolCallSyntaxError(message, self.pos)
+
+    def peek(self) -> str:
+        return self.text[self.pos] if self.pos < len(self.text) else ''
+
+    def skip_ws(self):
+        text, pos = self.text, self.pos
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        self.pos = pos
+
+    def expect(self, c:str):
+        self.skip_ws()
+        if self.peek() != c:
+            self.error(f"expected {c!r}")
+        self.pos += 1
+
+    def ident(self) -> str:
+        self.skip_ws()
+        text, start = self.text, self.pos
+        pos = start
+        while pos < len(text) and _is_ident_char(text[pos]):
+            pos += 1
+
+        if pos == start or text[start].isdigit():
+            self.error("expected a name")
+
+        self.pos = pos
+        return text[start:pos]
+
+    def sequence(self, close:str, item, depth:int) -> list:
+        '''comma separated items up to `close`, a trailing comma is allowed'''
+        items = []
+        while True:
+            self.skip_ws()
+            if self.peek() == close:
+                self.pos += 1
+                return items
+
+            items.append(item(depth))
+
+            self.skip_ws()
+            if self.peek() == ',':
+                self.pos += 1
+            elif self.peek() != close:
+                self.error(f"expected ',' or {close!r}")
+
+    def calls(self) -> list[tuple[str, dict[str, Any]]]:
+        self.expect('[')
+        calls = self.sequence(']', lambda _:self.call(), 0)
+        if not calls:
+            self.error("no tool call")
+
+        return calls
+
+    def call(self) -> tuple[str, dict[str, Any]]:
+        name = self.ident()
+        self.expect('(')
+        params = dict(self.sequence(')', lambda _:self.argument(), 0))
+
+        return name, params
+
+    def argument(self) -> tuple[str, Any]:
+        key = self.ident()
+        self.expect('=')
+        return key, self.value(1)
+
+    def value(self, depth:int) -> Any:
+        if depth > MAX_DEPTH:
+            self.error("too deeply nested")
+
+        self.skip_ws()
+        c = self.peek()
+
+        if c in ('"', "'"):
+            return self.string()
+
+        if c == '[':
+            self.pos += 1
+            return self.sequence(']', lambda d:self.value(d + 1), depth)
+
+        if c == '{':
+            self.pos += 1
+            return dict(self.sequence('}', lambda d:self.pair(d + 1), depth))
+
+        if c == '-' or c.isdigit():
+            return self.number()
+
+        # true/false/null, anything else unquoted is taken as a string
+        word = self.ident()
+        return LITERALS.get(word, word)
+
+    def pair(self, depth:int) -> tuple[str, Any]:
+        self.skip_ws()
+        key = self.string() if self.peek() in ('"', "'") else self.ident()
+        self.expect(':')
+        return key, self.value(depth)
+
+    def string(self) -> str:
+        text = self.text
+        quote = text[self.pos]
+        self.pos += 1
+
+        chunks = []
+        start = pos = self.pos
+        while pos < len(text):
+            c = text[pos]
+            if c == quote:
+                chunks.append(text[start:pos])
+                self.pos = pos + 1
+                return ''.join(chunks)
+
+            if c == '\\' and pos + 1 < len(text):
+                chunks.append(text[start:pos])
+                e = text[pos + 1]
+
+                if e == 'u' and pos + 6 <= len(text):
+                    try:
+                        chunks.append(chr(int(text[pos + 2:pos + 6], 16)))
+                        pos += 6
+                    except ValueError:
+                        self.pos = pos
+                        self.error("bad unicode escape")
+                else:
+                    chunks.append(ESCAPES.get(e, '\\' + e))
+                    pos += 2
+
+                start = pos
+                continue
+
+            pos += 1
+
+        self.pos = pos
+        self.error("unterminated string")
+
+    def number(self) -> int | float:
+        text, start = self.text, self.pos
+        pos = start + 1 if text[start] == '-' else start
+
+        while pos < len(text) and (text[pos].isdigit() or text[pos] in '.eE+-'):
+            # a sign is only part of the number right after the exponent
+            if text[pos] in '+-' and text[pos - 1] not in 'eE':
+                break
+            pos += 1
+
+        self.pos = pos
+        literal = text[start:pos]
+        try:
+            return int(literal)
+        except ValueError:
+            pass
+
+        try:
+            return float(literal)
+        except ValueError:
+            self.pos = start
+            self.error("bad number")
+
+
+def looks_like_tool_call(text:str) -> bool:
+    '''fast rejection of plain answers: a tool call list starts with `[name(`'''
+    text = text.lstrip()
+    if not text.startswith('['):
+        return False
+
+    i = 1
+    while i < len(text) and text[i].isspace():
+        i += 1
+
+    return i < len(text) and (text[i].isalpha() or text[i] == '_')
+
+
+def parse_tool_calls(text:str) -> list[tuple[str, dict[str, Any]]] | None:
+    '''
+    tool calls of a response in the `[func_name1(), func_name2(a="x", b=1)]` format,
+    None when it is a plain answer. anything after the closing bracket is ignored.
+    raises ToolCallSyntaxError when it starts like a call but is malformed
+    '''
+    if not looks_like_tool_call(text):
+        return None
+
+    return _Parser(text).calls()
+
@@ -1,4 +1,4 @@
-from typing import Optional, Literal
+from typing import Optional, Literal, Iterator, Callable
 import abc
 import pydantic
 
@@ -34,7 +34,11 @@ class BasePrompt:
         ...
     
     @abc.abstractmethod
-    def get_generation_prompt(self, tool_enabled:bool=False, last:int=50) -> str:
+    def get_generation_prompt(self, tool_enabled:bool=False, last:int=0) -> str:
+        ...
+
+    @abc.abstractmethod
+    def set_token_budget(self, count_tokens:Callable[[str], int], token_budget:int):
         ...
     
 
@@ -44,7 +48,18 @@ class BaseModel:
         '''generate a response based on the current prompt'''
         ...
 
+    @abc.abstractmethod
+    def generate_stream(self, prompt:BasePrompt) -> Iterator[str]:
+        '''generate a response, yielding the text as it is decoded'''
+        ...
+
+    @abc.abstractmethod
+    def count_tokens(self, text:str) -> int:
+        ...
+
 
 class AgentResponse(pydantic.BaseModel):
     type: Literal["text", "tool-calling", "tool-result"]
-    data: str
\ No newline at end of file
+    data: str
+    partial: bool = False  # a piece of the text being generated, the full text follows with partial=False
+    dropped: list[dict] = []  # tool-result: the chunks left out to fit the token budget
\ No newline at end of file
@@ -1,5 +1,21 @@
 from mcp import types
 import json
+import os
+import re
+
+#* words of the text, as the vault server's search tokenizes it
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def schema2type(schema:dict) -> str:
+    '''json schema type of a parameter, optional parameters (anyOf [T, null]) map to T'''
+    if 'type' in schema:
+        return schema['type']
+
+    for s in schema.get('anyOf', []):
+        if s.get('type', 'null') != 'null':
+            return s['type']
+
+    return 'string'
 
 def tool2dict(tool:types.Tool) -> dict:
     return {
@@ -8,7 +24,7 @@ def tool2dict(tool:types.Tool) -> dict:
         'parameters':{
             'type':tool.inputSchema.get('type','object'),
             'required':tool.inputSchema.get('required',[]),
-            'properties':{k:{'type':v['type']} for k,v in tool.inputSchema.get('properties',{}).items()}
+            'properties':{k:{'type':schema2type(v)} for k,v in tool.inputSchema.get('properties',{}).items()}
         }
     }
 
@@ -19,24 +35,38 @@ def resource2dict(resource:types.Resource) -> dict:
         'mimeType':resource.mimeType,
     }
 
-def param2dict(pram_s:str) -> dict:
-    params = {}
-    
-    if not pram_s:
-        return params
-    
-    param_list = pram_s.split(',')
-
-    for p in param_list:
-        k,v = p.strip().split('=')
-        params[k] = v.strip('\'\"')
-
-    return params
-
 def result2dict(result:types.TextContent):
     return result.text
 
+def tokenize(text:str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
 def uri2path(s):
     """Convert URI to path, properly handling URL encoding/decoding"""
     from urllib.parse import unquote
-    return unquote(str(s))
\ No newline at end of file
+    return unquote(str(s))
+
+def rss_bytes() -> int:
+    """Resident memory of this process (0 where /proc is not available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def available_bytes() -> int:
+    """Memory available for new allocations without swapping (0 where /proc is not available)"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return 0
+
+
+def memory_usage() -> str:
+    return f"rss {rss_bytes() / 1024**2:.0f}MiB, available {available_bytes() / 1024**2:.0f}MiB"
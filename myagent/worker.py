@@ -0,0 +1,278 @@
+from typing import AsyncGenerator, Hashable
+from collections import deque
+import asyncio
+import logging
+import threading
+import time
+
+from .types import BaseModel
+from . import errors
+
+logger = logging.getLogger('agent.worker')
+
+_DONE = object()
+
+
+class GenerationRequest:
+    def __init__(self, prompt:str, kwargs:dict, loop:asyncio.AbstractEventLoop, deadline:float|None, max_pending:int, session:Hashable=None) -> None:
+        self.prompt:str = prompt
+        self.kwargs:dict = kwargs
+        self.deadline:float|None = deadline
+        self.session:Hashable = session
+        self.queued_at:float = time.monotonic()
+
+        self.loop:asyncio.AbstractEventLoop = loop
+        self.output:asyncio.Queue = asyncio.Queue()
+        self.cancelled:threading.Event = threading.Event()
+
+        # deltas pushed but not consumed yet, the worker waits when the consumer falls behind
+        self.pending:threading.Semaphore = threading.Semaphore(max_pending)
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def remaining(self) -> float | None:
+        '''seconds left before the deadline (None without one)'''
+        return None if self.deadline is None else max(self.deadline - time.monotonic(), 0.0)
+
+    def push(self, item) -> bool:
+        try:
+            self.loop.call_soon_threadsafe(self.output.put_nowait, item)
+            return True
+        except RuntimeError:
+            # the consumer's event loop is closed
+            self.cancelled.set()
+            return False
+
+
+class WorkerStats:
+    '''queue wait and throughput of the generation worker, updated by its thread'''
+    def __init__(self) -> None:
+        self.requests:int = 0
+        self.deltas:int = 0
+        self.busy:float = 0.0
+
+        self.total_wait:float = 0.0
+        self.max_wait:float = 0.0
+        # the queue waits of the latest requests, for the percentiles
+        self.waits:deque[float] = deque(maxlen=256)
+
+        self.since:float = time.monotonic()
+
+    def started(self, wait:float):
+        self.requests += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.waits.append(wait)
+
+    def finished(self, n_deltas:int, elapsed:float):
+        self.deltas += n_deltas
+        self.busy += elapsed
+
+    def snapshot(self) -> dict[str, int | float]:
+        waits = sorted(self.waits)
+        uptime = time.monotonic() - self.since
+
+        return {
+            'requests':self.requests,
+            'avg_queue_wait':round(self.total_wait / self.requests, 4) if self.requests else 0.0,
+            'p95_queue_wait':round(waits[min(int(len(waits) * 0.95), len(waits) - 1)], 4) if waits else 0.0,
+            'max_queue_wait':round(self.max_wait, 4),
+            'deltas_per_sec':round(self.deltas / self.busy, 2) if self.busy else 0.0,
+            'requests_per_min':round(self.requests / uptime * 60, 2) if uptime else 0.0,
+            'utilization':round(self.busy / uptime, 4) if uptime else 0.0,
+        }
+
+
+class GenerationWorker:
+    '''
+    runs the model on a dedicated thread, one request at a time
+
+    requests wait in a bounded queue (submitting blocks when it is full) and their deltas are
+    handed back to the caller's event loop, so MCP I/O and UI events keep flowing while the
+    model decodes. a request stops between two tokens when it is cancelled, its consumer goes
+    away or its deadline passes.
+
+    requests of different sessions take turns (round robin), so a session queueing several
+    requests does not hold the others back; requests of one session run in order.
+    '''
+    def __init__(self, model:BaseModel, max_queue:int=4, max_pending:int=64) -> None:
+        self.model:BaseModel = model
+        self.max_queue:int = max_queue
+        self.max_pending:int = max_pending
+
+        # session -> its queued requests, and the sessions having some in the order they are served
+        self._queues:dict[Hashable, deque[GenerationRequest]] = {}
+        self._turns:deque[Hashable] = deque()
+        self._queued:int = 0
+        self._closing:bool = False
+        self._cond = threading.Condition()
+
+        self._active:set[GenerationRequest] = set()
+        self._lock = threading.Lock()
+        self._thread:threading.Thread | None = None
+
+        self.stats:WorkerStats = WorkerStats()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._closing = False
+            self._thread = threading.Thread(target=self._run, name='generation-worker', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self.cancel()
+
+        if self._thread is not None and self._thread.is_alive():
+            with self._cond:
+                self._closing = True
+                self._cond.notify_all()
+            self._thread.join()
+
+        self._thread = None
+
+    def cancel(self, session:Hashable=None):
+        '''stop the running request and drop the queued ones (only those of `session` if given)'''
+        with self._lock:
+            for request in self._active:
+                if session is None or request.session == session:
+                    request.cancelled.set()
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _put(self, request:GenerationRequest) -> bool:
+        '''queue the request, False when it was cancelled or its deadline passed before there was room'''
+        with self._cond:
+            # waits in slices, so a cancelled request does not keep the calling thread parked
+            while not self._cond.wait_for(lambda:self._queued < self.max_queue, timeout=0.1):
+                if request.cancelled.is_set() or request.expired():
+                    return False
+
+            if request.session not in self._queues:
+                self._queues[request.session] = deque()
+                self._turns.append(request.session)
+
+            self._queues[request.session].append(request)
+            self._queued += 1
+            self._cond.notify_all()
+
+        return True
+
+    def _get(self) -> GenerationRequest | None:
+        with self._cond:
+            self._cond.wait_for(lambda:self._queued or self._closing)
+            if self._closing:
+                return None
+
+            session = self._turns.popleft()
+            requests = self._queues[session]
+            request = requests.popleft()
+
+            # the session goes to the back of the line if it has more requests
+            if requests:
+                self._turns.append(session)
+            else:
+                del self._queues[session]
+
+            self._queued -= 1
+            self._cond.notify_all()
+
+        return request
+
+    def _run(self):
+        while (request := self._get()) is not None:
+            try:
+                self._generate(request)
+            except Exception as e:
+                request.push(e)
+            else:
+                request.push(_DONE)
+            finally:
+                with self._lock:
+                    self._active.discard(request)
+
+    def _generate(self, request:GenerationRequest):
+        if request.cancelled.is_set():
+            return
+
+        start = time.monotonic()
+        self.stats.started(start - request.queued_at)
+
+        if request.expired():
+            raise errors.GenerationTimeout("generation request timed out in the queue")
+
+        deltas = self.model.generate_stream(request.prompt, **request.kwargs)
+        n_tokens = 0
+
+        try:
+            for delta in deltas:
+                # back-pressure: wait for the consumer, but keep watching for a cancellation
+                while not request.pending.acquire(timeout=0.1):
+                    if request.cancelled.is_set() or request.expired():
+                        break
+
+                if request.cancelled.is_set():
+                    logger.debug(f"generation cancelled after {n_tokens} deltas")
+                    return
+
+                if request.expired():
+                    raise errors.GenerationTimeout(f"generation timed out after {n_tokens} deltas")
+
+                if not request.push(delta):
+                    return
+                n_tokens += 1
+        finally:
+            # stops llama.cpp decoding if we left the loop early
+            deltas.close()
+            self.stats.finished(n_tokens, time.monotonic() - start)
+
+        logger.debug(f"generated {n_tokens} deltas in {time.monotonic() - start:.2f}s")
+
+    async def stream(self, prompt:str, timeout:float|None=None, session:Hashable=None, **kwargs) -> AsyncGenerator[str, None]:
+        '''
+        text deltas of `prompt`. closing the generator (or cancelling the task iterating it)
+        cancels the request
+        '''
+        self.start()
+
+        deadline = time.monotonic() + timeout if timeout else None
+        request = GenerationRequest(prompt, kwargs, asyncio.get_running_loop(), deadline, self.max_pending, session=session)
+
+        with self._lock:
+            self._active.add(request)
+
+        try:
+            if not await asyncio.to_thread(self._put, request):
+                with self._lock:
+                    self._active.discard(request)
+
+                if request.cancelled.is_set():
+                    return
+                raise errors.GenerationTimeout("generation queue is full")
+
+            while (item := await self._next(request)) is not _DONE:
+                if isinstance(item, Exception):
+                    raise item
+
+                request.pending.release()
+                yield item
+        finally:
+            request.cancelled.set()
+
+    async def _next(self, request:GenerationRequest):
+        '''
+        the next item of the request, the deadline also bounds the waits the worker cannot check
+        (the request queued behind others, the prompt being evaluated before the first delta)
+        '''
+        if not request.output.empty():
+            return request.output.get_nowait()
+
+        try:
+            return await asyncio.wait_for(request.output.get(), timeout=request.remaining())
+        except asyncio.TimeoutError:
+            raise errors.GenerationTimeout("generation timed out waiting for the model") from None
+
+    async def generate(self, prompt:str, timeout:float|None=None, session:Hashable=None, **kwargs) -> str:
+        return ''.join([delta async for delta in self.stream(prompt, timeout=timeout, session=session, **kwargs)]).strip()
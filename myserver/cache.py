@@ -0,0 +1,104 @@
+from collections import OrderedDict
+import asyncio
+import os
+
+from .config import CONTENT_CACHE_BYTES
+
+
+def _read_bytes(path:str) -> bytes:
+    with open(path, 'rb') as fd:
+        return fd.read()
+
+
+class ContentCache:
+    '''
+    LRU cache of note contents bounded by a byte budget
+
+    entries are validated against (size, mtime) on every read, so a stale entry is never served
+    even when the watcher is off. the watcher invalidates entries eagerly to free the memory.
+    a budget of 0 disables the cache, every read goes to the disk.
+    '''
+    def __init__(self, max_bytes:int) -> None:
+        self.max_bytes:int = max_bytes
+        self.max_entry_bytes:int = max_bytes // 8
+
+        self._entries:OrderedDict[str, tuple[int, int, bytes]] = OrderedDict()
+        self.nbytes:int = 0
+
+        self.hits:int = 0
+        self.misses:int = 0
+        self.evictions:int = 0
+
+    def get(self, path:str, size:int, mtime_ns:int) -> bytes | None:
+        entry = self._entries.get(path)
+        if entry is None or entry[:2] != (size, mtime_ns):
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return entry[2]
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def put(self, path:str, size:int, mtime_ns:int, data:bytes):
+        self.invalidate(path)
+
+        if not self.enabled or len(data) > self.max_entry_bytes:
+            return
+
+        self._entries[path] = (size, mtime_ns, data)
+        self.nbytes += len(data)
+
+        while self.nbytes > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, path:str):
+        if entry := self._entries.pop(path, None):
+            self.nbytes -= len(entry[2])
+
+    async def read(self, path:str) -> bytes:
+        if not self.enabled:
+            return await asyncio.to_thread(_read_bytes, path)
+
+        st = os.stat(path)
+
+        data = self.get(path, st.st_size, st.st_mtime_ns)
+        if data is None:
+            # one thread-pool round trip for open+read+close
+            data = await asyncio.to_thread(_read_bytes, path)
+            self.put(path, st.st_size, st.st_mtime_ns, data)
+
+        return data
+
+    def peek(self, path:str) -> bytes | None:
+        '''cached contents if still valid, without touching the counters or the LRU order'''
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        return entry[2] if entry[:2] == (st.st_size, st.st_mtime_ns) else None
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'evictions':self.evictions,
+            'hit_rate':round(self.hits / total, 4) if total else 0.0,
+            'entries':len(self._entries),
+            'bytes':self.nbytes,
+            'max_bytes':self.max_bytes,
+        }
+
+
+content_cache = ContentCache(CONTENT_CACHE_BYTES)
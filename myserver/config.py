@@ -15,4 +15,11 @@ class Config:
         return self.data.get(name, None)
 
 config = Config.from_json('config.json')
-VAULT_PATH = config['VAULT_PATH']
\ No newline at end of file
+VAULT_PATH = config['VAULT_PATH']
+INDEX_DIR = config['INDEX_DIR'] or '.index'
+WATCH_MODE = config['WATCH_MODE'] or 'off'
+#* 0 disables the cache, so it cannot fall back to the default like the other options
+CONTENT_CACHE_BYTES = int(config['CONTENT_CACHE_BYTES'] if config['CONTENT_CACHE_BYTES'] is not None else 64 * 1024 * 1024)
+BATCH_READ_CONCURRENCY = config['BATCH_READ_CONCURRENCY'] or 8
+BATCH_READ_MAX_BYTES = config['BATCH_READ_MAX_BYTES'] or 512 * 1024
+RESOURCE_PAGE_SIZE = config['RESOURCE_PAGE_SIZE'] or 1000
@@ -0,0 +1,242 @@
+from array import array
+from urllib.parse import unquote
+import posixpath
+import re
+
+from .index import DocIndex
+
+WIKILINK_PATTERN = re.compile(r'!?\[\[([^\[\]\n]+?)\]\]')
+MDLINK_PATTERN = re.compile(r'\[[^\]\n]*\]\(<?([^)<>\s]+?\.md)>?(?:#[^)\s]*)?\)')
+FENCED_CODE_PATTERN = re.compile(r'^(```|~~~).*?^\1', re.MULTILINE | re.DOTALL)
+
+
+def link_key(target:str) -> str:
+    '''normalized link target: lowercase path or name without the .md suffix, heading and alias'''
+    target = re.split(r'[|#^]', target, maxsplit=1)[0].strip().replace('\\', '/').lower()
+    return target[:-3] if target.endswith('.md') else target
+
+
+def parse_links(rel_path:str, text:str) -> list[str]:
+    '''[[wikilinks]], ![[embeds]] and relative [markdown](links.md) of a note, as link keys'''
+    text = FENCED_CODE_PATTERN.sub('', text)
+
+    keys = [link_key(m.group(1)) for m in WIKILINK_PATTERN.finditer(text)]
+
+    base = posixpath.dirname(rel_path)
+    for m in MDLINK_PATTERN.finditer(text):
+        target = unquote(m.group(1))
+        if '://' in target:
+            continue
+
+        keys.append(link_key(posixpath.normpath(posixpath.join(base, target)).lstrip('/')))
+
+    return list(dict.fromkeys(k for k in keys if k))
+
+
+class LinkIndex(DocIndex):
+    '''
+    link graph of the vault
+
+    the link keys of every note are extracted once per content change. links are resolved
+    Obsidian-style (full path, path suffix, then note name) into CSR arrays of note ids:
+    `out_targets[out_offsets[i]:out_offsets[i+1]]` are the notes linked from note i and
+    `in_sources[in_offsets[i]:in_offsets[i+1]]` the notes linking to it.
+
+    editing a note only patches a small overlay on top of the arrays (its new out-links and the
+    in-link deltas of its targets). adding or removing notes can change how links resolve,
+    so the arrays are rebuilt lazily on the first query after that.
+    '''
+    MAX_PATCHES = 4096
+
+    VERSION = 1
+
+    def __init__(self, index_path:str) -> None:
+        super().__init__(index_path)
+
+        self.links:dict[str, list[str]] = {}
+
+        self.paths:list[str] = []
+        self.path2id:dict[str, int] = {}
+        self.out_offsets:array = array('I', [0])
+        self.out_targets:array = array('I')
+        self.in_offsets:array = array('I', [0])
+        self.in_sources:array = array('I')
+
+        self._dirty:bool = True
+        self._resolved:dict[str, int | None] = {}
+        self._out_patch:dict[int, list[int]] = {}
+        self._in_added:dict[int, set[int]] = {}
+        self._in_removed:dict[int, set[int]] = {}
+
+    def _add(self, rel_path:str, text:str):
+        self.links[rel_path] = parse_links(rel_path, text)
+
+        i = self.path2id.get(rel_path)
+        if self._dirty or i is None or len(self._out_patch) >= self.MAX_PATCHES:
+            self._dirty = True
+            return
+
+        # an edited note: the set of notes (and so the resolution) did not change
+        old = set(self._out(i))
+        new = set()
+        for key in self.links[rel_path]:
+            if key not in self._resolved:
+                self._resolved[key] = self._resolve(key)
+
+            if (j := self._resolved[key]) is not None and j != i:
+                new.add(j)
+
+        for j in old - new:
+            if i in self._in_added.get(j, ()):
+                self._in_added[j].discard(i)
+            else:
+                self._in_removed.setdefault(j, set()).add(i)
+
+        for j in new - old:
+            if i in self._in_removed.get(j, ()):
+                self._in_removed[j].discard(i)
+            else:
+                self._in_added.setdefault(j, set()).add(i)
+
+        self._out_patch[i] = sorted(new)
+
+    def _remove(self, rel_path:str):
+        # also called for an edit right before `_add`, which decides whether to rebuild
+        self.links.pop(rel_path, None)
+
+    def remove(self, rel_path:str):
+        super().remove(rel_path)
+        self._dirty = True
+
+    def _dump(self) -> dict:
+        return {'links':self.links}
+
+    def _restore(self, state:dict):
+        self.links = state['links']
+        self._dirty = True
+
+    def _out(self, i:int) -> list[int]:
+        if (patch := self._out_patch.get(i)) is not None:
+            return patch
+
+        return list(self.out_targets[self.out_offsets[i]:self.out_offsets[i + 1]])
+
+    def _in(self, i:int) -> list[int]:
+        sources = list(self.in_sources[self.in_offsets[i]:self.in_offsets[i + 1]])
+
+        if removed := self._in_removed.get(i):
+            sources = [j for j in sources if j not in removed]
+
+        if added := self._in_added.get(i):
+            sources += sorted(added)
+
+        return sources
+
+    def _resolver(self):
+        lookup:dict[str, int] = {}
+
+        # full paths win over names, and the shortest path wins when several notes share a name
+        order = sorted(range(len(self.paths)), key=lambda i:(self.paths[i].count('/'), self.paths[i]), reverse=True)
+        keys = {i:link_key(self.paths[i]) for i in order}
+        for i in order:
+            lookup[posixpath.basename(keys[i])] = i
+        for i in order:
+            lookup[keys[i]] = i
+
+        def resolve(key:str) -> int | None:
+            if (i := lookup.get(key)) is not None or '/' not in key:
+                return i
+
+            # partial path like [[folder/note]]
+            i = lookup.get(posixpath.basename(key))
+            if i is not None and keys[i].endswith(f"/{key}"):
+                return i
+
+            return None
+
+        return resolve
+
+    def _build(self):
+        self.paths = list(self.links)
+        self.path2id = {p:i for i,p in enumerate(self.paths)}
+        self._resolve = resolve = self._resolver()
+
+        out_offsets, out_targets = array('I', [0]), array('I')
+        in_degree = [0] * len(self.paths)
+
+        self._resolved = resolved = {}
+        for i, rel_path in enumerate(self.paths):
+            targets = set()
+            for key in self.links[rel_path]:
+                if key not in resolved:
+                    resolved[key] = resolve(key)
+
+                if (j := resolved[key]) is not None and j != i:
+                    targets.add(j)
+
+            out_targets.extend(sorted(targets))
+            out_offsets.append(len(out_targets))
+
+            for j in targets:
+                in_degree[j] += 1
+
+        # counting sort of the edges by target
+        in_offsets = array('I', [0])
+        for d in in_degree:
+            in_offsets.append(in_offsets[-1] + d)
+
+        in_sources = array('I', [0]) * len(out_targets)
+        cursor = list(in_offsets[:-1])
+        for i in range(len(self.paths)):
+            for j in out_targets[out_offsets[i]:out_offsets[i + 1]]:
+                in_sources[cursor[j]] = i
+                cursor[j] += 1
+
+        self.out_offsets, self.out_targets = out_offsets, out_targets
+        self.in_offsets, self.in_sources = in_offsets, in_sources
+
+        self._out_patch, self._in_added, self._in_removed = {}, {}, {}
+        self._dirty = False
+
+    def _id(self, rel_path:str) -> int:
+        if self._dirty:
+            self._build()
+
+        if (i := self.path2id.get(rel_path)) is None:
+            raise ValueError(f"Not an indexed doc({rel_path})")
+
+        return i
+
+    def outlinks(self, rel_path:str) -> list[str]:
+        return [self.paths[j] for j in self._out(self._id(rel_path))]
+
+    def backlinks(self, rel_path:str) -> list[str]:
+        return [self.paths[j] for j in self._in(self._id(rel_path))]
+
+    def _neighbors(self, i:int) -> set[int]:
+        return set(self._out(i)) | set(self._in(i))
+
+    def related(self, rel_path:str, depth:int=2, k:int=10) -> list[tuple[str, float]]:
+        '''
+        notes near `rel_path` in the (undirected) link graph, ranked by a truncated random walk:
+        every step spreads a note's weight evenly over its neighbours, so hubs count less
+        '''
+        seed = self._id(rel_path)
+
+        scores:dict[int, float] = {}
+        frontier = {seed:1.0}
+        for _ in range(max(depth, 1)):
+            spread:dict[int, float] = {}
+            for i, w in frontier.items():
+                neighbors = self._neighbors(i)
+                for j in neighbors:
+                    spread[j] = spread.get(j, 0.0) + w / len(neighbors)
+
+            for j, w in spread.items():
+                scores[j] = scores.get(j, 0.0) + w
+
+            frontier = spread
+
+        scores.pop(seed, None)
+        top = sorted(scores.items(), key=lambda x:-x[1])[:k]
+        return [(self.paths[j], score) for j, score in top]
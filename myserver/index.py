@@ -0,0 +1,299 @@
+from typing import NamedTuple
+import abc
+import hashlib
+import json
+import os
+import pickle
+
+
+class IndexEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+    digest: str
+
+
+class DirRecord(NamedTuple):
+    mtime_ns: int
+    subdirs: list[str]
+    files: list[str]
+
+
+class IndexChanges(NamedTuple):
+    added: list[str]
+    modified: list[str]
+    removed: list[str]
+
+    def __bool__(self):
+        return bool(self.added or self.modified or self.removed)
+
+
+def file_digest(path:str) -> str:
+    with open(path, 'rb') as fd:
+        return hashlib.blake2b(fd.read(), digest_size=16).hexdigest()
+
+
+class VaultIndex:
+    '''
+    on-disk index of the markdown notes in the vault (relative path -> size, mtime, content hash)
+
+    directories are remembered with their mtime and listing. on reconcile, a directory whose
+    mtime did not change reuses its cached listing, so only directories where notes were added,
+    removed or renamed are listed again. in-place edits do not change the folder mtime: with
+    `stat_files` (startup) every note is re-stated and only re-hashed when its size or mtime
+    changed, otherwise they are picked up by the watcher or `update_file`.
+    `reconcile_paths` only walks the folders around a batch of touched paths.
+    '''
+    VERSION = 1
+
+    def __init__(self, root:str, index_path:str) -> None:
+        self.root:str = root
+        self.index_path:str = index_path
+
+        self.files:dict[str, IndexEntry] = {}
+        self.dirs:dict[str, DirRecord] = {}
+
+    def abspath(self, rel_path:str) -> str:
+        return os.path.join(self.root, rel_path)
+
+    def load(self) -> bool:
+        try:
+            with open(self.index_path) as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return False
+
+        if data.get('version') != self.VERSION or data.get('root') != os.path.abspath(self.root):
+            return False
+
+        self.files = {k:IndexEntry(*v) for k,v in data['files'].items()}
+        self.dirs = {k:DirRecord(*v) for k,v in data['dirs'].items()}
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+
+        data = {
+            'version':self.VERSION,
+            'root':os.path.abspath(self.root),
+            'files':self.files,
+            'dirs':self.dirs,
+        }
+
+        # write-then-rename so a crash never leaves a truncated index behind
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w') as fd:
+            json.dump(data, fd, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def _scan_dir(self, rel_dir:str) -> DirRecord | None:
+        path = self.abspath(rel_dir)
+
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        record = self.dirs.get(rel_dir)
+        if record and record.mtime_ns == mtime_ns:
+            return record
+
+        subdirs, files = [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    # skip .obsidian, .trash, .git and friends
+                    if entry.name.startswith('.'):
+                        continue
+
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.name.endswith('.md') and entry.is_file():
+                        files.append(entry.name)
+        except OSError:
+            # deleted while walking, or unreadable
+            return None
+
+        return DirRecord(mtime_ns, subdirs, files)
+
+    def _covered(self, rel_path:str, roots:set[str]) -> bool:
+        '''whether `rel_path` is one of the folders `roots` or lies below one'''
+        while True:
+            if rel_path in roots:
+                return True
+            if not rel_path:
+                return False
+            rel_path = rel_path.rpartition('/')[0]
+
+    def _known_parent(self, rel_path:str) -> str:
+        '''the closest indexed folder above `rel_path`'''
+        parent = rel_path.rpartition('/')[0]
+        while parent and parent not in self.dirs:
+            parent = parent.rpartition('/')[0]
+
+        return parent
+
+    def reconcile(self, stat_files:bool=False, roots:set[str]|None=None) -> IndexChanges:
+        '''
+        walk the vault (or only the folders `roots` and below) and bring the index up to date
+        (`stat_files` also checks notes of unchanged folders)
+        '''
+        changes = IndexChanges([], [], [])
+
+        roots = {''} if roots is None else {r for r in roots if not r or not self._covered(r.rpartition('/')[0], roots)}
+
+        dirs:dict[str, DirRecord] = {}
+        seen:set[str] = set()
+        changed_dirs:set[str] = set()
+
+        stack = list(roots)
+        while stack:
+            rel_dir = stack.pop()
+            record = self._scan_dir(rel_dir)
+            if record is None:
+                continue
+
+            if record is not self.dirs.get(rel_dir):
+                changed_dirs.add(rel_dir)
+
+            dirs[rel_dir] = record
+            for name in record.subdirs:
+                stack.append(f"{rel_dir}/{name}" if rel_dir else name)
+
+            for name in record.files:
+                seen.add(f"{rel_dir}/{name}" if rel_dir else name)
+
+        for rel_dir in (dirs if stat_files else changed_dirs):
+            for name in dirs[rel_dir].files:
+                rel_path = f"{rel_dir}/{name}" if rel_dir else name
+
+                status = self.update_file(rel_path)
+                if status == 'added':
+                    changes.added.append(rel_path)
+                elif status == 'modified':
+                    changes.modified.append(rel_path)
+
+        for rel_path in list(self.files):
+            if rel_path not in seen and self._covered(rel_path.rpartition('/')[0], roots):
+                del self.files[rel_path]
+                changes.removed.append(rel_path)
+
+        if '' in roots:
+            self.dirs = dirs
+        else:
+            self.dirs = {k:v for k,v in self.dirs.items() if not self._covered(k, roots)} | dirs
+
+        return changes
+
+    def reconcile_paths(self, touched:set[str]) -> IndexChanges:
+        '''bring the index up to date for a batch of touched notes or folders, walking only the folders around them'''
+        changes = self.reconcile(roots={self._known_parent(rel_path) for rel_path in touched})
+
+        # in-place edits do not change the folder mtime, re-check the touched notes
+        for rel_path in touched:
+            if rel_path in self.files and rel_path not in changes.added:
+                if self.update_file(rel_path) == 'modified':
+                    changes.modified.append(rel_path)
+
+        return changes
+
+    def update_file(self, rel_path:str) -> str | None:
+        '''
+        re-stat a single note and refresh its entry
+        returns 'added', 'modified', 'removed' or None when the contents did not change
+        '''
+        path = self.abspath(rel_path)
+        old = self.files.get(rel_path)
+
+        try:
+            st = os.stat(path)
+            if old and (old.size, old.mtime_ns) == (st.st_size, st.st_mtime_ns):
+                return None
+
+            digest = file_digest(path)
+        except OSError:
+            return self.remove_file(rel_path)
+
+        self.files[rel_path] = IndexEntry(st.st_size, st.st_mtime_ns, digest)
+
+        if old is None:
+            return 'added'
+
+        return 'modified' if old.digest != digest else None
+
+    def remove_file(self, rel_path:str) -> str | None:
+        if self.files.pop(rel_path, None) is None:
+            return None
+
+        return 'removed'
+
+
+class DocIndex(abc.ABC):
+    '''
+    base class of the indexes derived from note contents (search, outline, ...)
+
+    every note is tagged with the content digest it was indexed at, so only the notes
+    whose digest differs from the VaultIndex need to be re-processed (see `stale`).
+    subclasses implement `_add`, `_remove`, `_dump` and `_restore`.
+    '''
+    VERSION = 1
+
+    def __init__(self, index_path:str) -> None:
+        self.index_path:str = index_path
+        self.digests:dict[str, str] = {}
+
+    def load(self) -> bool:
+        try:
+            with open(self.index_path, 'rb') as fd:
+                data = pickle.load(fd)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return False
+
+        if data.get('version') != self.VERSION:
+            return False
+
+        self.digests = data['digests']
+        self._restore(data['state'])
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+
+        data = {'version':self.VERSION, 'digests':self.digests, 'state':self._dump()}
+
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'wb') as fd:
+            pickle.dump(data, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+    def stale(self, vault:VaultIndex) -> tuple[list[str], list[str]]:
+        '''returns (paths to re-index, paths to drop)'''
+        outdated = [k for k,v in vault.files.items() if self.digests.get(k) != v.digest]
+        removed = [k for k in self.digests if k not in vault.files]
+        return outdated, removed
+
+    def update(self, rel_path:str, digest:str, text:str):
+        if rel_path in self.digests:
+            self._remove(rel_path)
+
+        self.digests[rel_path] = digest
+        self._add(rel_path, text)
+
+    def remove(self, rel_path:str):
+        if self.digests.pop(rel_path, None) is not None:
+            self._remove(rel_path)
+
+    @abc.abstractmethod
+    def _add(self, rel_path:str, text:str):
+        ...
+
+    @abc.abstractmethod
+    def _remove(self, rel_path:str):
+        ...
+
+    @abc.abstractmethod
+    def _dump(self) -> dict:
+        ...
+
+    @abc.abstractmethod
+    def _restore(self, state:dict):
+        ...
@@ -0,0 +1,255 @@
+from typing import Callable, Iterator
+import re
+
+from .graph import FENCED_CODE_PATTERN
+from .index import DocIndex
+
+INLINE_TAG_PATTERN = re.compile(r'(?<![\w/&#])#([^\W\d][\w/-]*|\d+[^\W\d][\w/-]*)')
+INLINE_CODE_PATTERN = re.compile(r'`[^`\n]*`')
+
+OPERATORS = ('>=', '<=', '!=', '>', '<', '=')
+
+
+def _unquote(value:str) -> str:
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '\'"':
+        return value[1:-1]
+
+    return value
+
+
+def parse_frontmatter(text:str) -> tuple[dict[str, list[str]], int]:
+    '''
+    flat YAML frontmatter (scalars, [inline, lists] and block lists) as key -> values
+    returns the properties and the offset where the body starts
+    '''
+    if not text.startswith('---'):
+        return {}, 0
+
+    lines = text.splitlines(keepends=True)
+    if lines[0].rstrip() != '---':
+        return {}, 0
+
+    props:dict[str, list[str]] = {}
+    key = None
+    offset = len(lines[0])
+
+    for line in lines[1:]:
+        offset += len(line)
+        stripped = line.strip()
+
+        if stripped in ('---', '...'):
+            return props, offset
+
+        if not stripped or stripped.startswith('#'):
+            continue
+
+        if stripped.startswith('- ') and key:
+            props[key].append(_unquote(stripped[2:]))
+
+        elif ':' in line and not line[0].isspace():
+            key, _, value = line.partition(':')
+            key, value = key.strip().lower(), value.strip()
+
+            if value.startswith('[') and value.endswith(']'):
+                props[key] = [_unquote(v) for v in value[1:-1].split(',') if v.strip()]
+            else:
+                props[key] = [_unquote(value)] if value else []
+
+    # no closing fence, not a frontmatter
+    return {}, 0
+
+
+def parse_tags(props:dict[str, list[str]], body:str) -> set[str]:
+    '''frontmatter `tags` and inline #tags. nested tags also count for their parents (#a/b -> a, a/b)'''
+    tags = set()
+    for value in props.get('tags', []) + props.get('tag', []):
+        tags.update(t.lstrip('#') for t in re.split(r'[,\s]+', value) if t.lstrip('#'))
+
+    body = INLINE_CODE_PATTERN.sub('', FENCED_CODE_PATTERN.sub('', body))
+    tags.update(m.group(1) for m in INLINE_TAG_PATTERN.finditer(body))
+
+    expanded = set()
+    for tag in tags:
+        parts = tag.lower().strip('/').split('/')
+        expanded.update('/'.join(parts[:i + 1]) for i in range(len(parts)))
+
+    return expanded
+
+
+def bitmap_of(ids:list[int]) -> int:
+    data = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        data[i >> 3] |= 1 << (i & 7)
+
+    return int.from_bytes(data, 'little')
+
+
+def iter_bits(bitmap:int) -> Iterator[int]:
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for idx, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield idx * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+class MetaIndex(DocIndex):
+    '''
+    tag and frontmatter index
+
+    every note gets a small integer id. each tag and each (property, value) pair keeps a bitmap
+    (a python int, bit i = note i), so a query is a few big-int ANDs and a facet count is a popcount.
+    added notes are merged into the bitmaps in one batch before the next query, since setting
+    one bit at a time copies the whole bitmap
+    '''
+    VERSION = 1
+
+    def __init__(self, index_path:str) -> None:
+        super().__init__(index_path)
+
+        self.paths:list[str | None] = []
+        self.path2id:dict[str, int] = {}
+        self.free_ids:list[int] = []
+
+        # note id -> (tags, props), used to clear the bits again on removal
+        self.docs:dict[int, tuple[set[str], dict[str, list[str]]]] = {}
+
+        self.tags:dict[str, int] = {}
+        self.props:dict[str, dict[str, int]] = {}
+        self.alive:int = 0
+
+        self._pending:list[int] = []
+
+    def _add(self, rel_path:str, text:str):
+        props, body_start = parse_frontmatter(text)
+        props = {k:[v.lower() for v in vs] for k,vs in props.items()}
+        tags = parse_tags(props, text[body_start:])
+
+        doc_id = self.free_ids.pop() if self.free_ids else len(self.paths)
+        if doc_id == len(self.paths):
+            self.paths.append(rel_path)
+        else:
+            self.paths[doc_id] = rel_path
+
+        self.path2id[rel_path] = doc_id
+        self.docs[doc_id] = (tags, props)
+        self._pending.append(doc_id)
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        tag_ids:dict[str, list[int]] = {}
+        prop_ids:dict[tuple[str, str], list[int]] = {}
+
+        for doc_id in self._pending:
+            tags, props = self.docs[doc_id]
+
+            for tag in tags:
+                tag_ids.setdefault(tag, []).append(doc_id)
+
+            for key, values in props.items():
+                for value in values:
+                    prop_ids.setdefault((key, value), []).append(doc_id)
+
+        self.alive |= bitmap_of(self._pending)
+
+        for tag, ids in tag_ids.items():
+            self.tags[tag] = self.tags.get(tag, 0) | bitmap_of(ids)
+
+        for (key, value), ids in prop_ids.items():
+            column = self.props.setdefault(key, {})
+            column[value] = column.get(value, 0) | bitmap_of(ids)
+
+        self._pending = []
+
+    def _remove(self, rel_path:str):
+        self._flush()
+
+        doc_id = self.path2id.pop(rel_path)
+        tags, props = self.docs.pop(doc_id)
+
+        mask = ~(1 << doc_id)
+        self.alive &= mask
+
+        for tag in tags:
+            if not (bitmap := self.tags[tag] & mask):
+                del self.tags[tag]
+            else:
+                self.tags[tag] = bitmap
+
+        for key, values in props.items():
+            column = self.props[key]
+            for value in values:
+                if not (bitmap := column[value] & mask):
+                    del column[value]
+                else:
+                    column[value] = bitmap
+
+            if not column:
+                del self.props[key]
+
+        self.paths[doc_id] = None
+        self.free_ids.append(doc_id)
+
+    def _match(self, key:str, condition:str) -> int:
+        column = self.props.get(key.lower(), {})
+
+        op = next((o for o in OPERATORS if condition.startswith(o)), '=')
+        value = condition[len(op):].strip().lower() if condition.startswith(op) else condition.strip().lower()
+
+        if op == '=':
+            return column.get(value, 0)
+
+        if op == '!=':
+            return self.alive & ~column.get(value, 0)
+
+        # range conditions compare the values as strings, which works for ISO dates and padded numbers
+        compare:dict[str, Callable[[str], bool]] = {
+            '>':lambda v:v > value, '>=':lambda v:v >= value, '<':lambda v:v < value, '<=':lambda v:v <= value,
+        }
+        bitmap = 0
+        for v, bits in column.items():
+            if compare[op](v):
+                bitmap |= bits
+
+        return bitmap
+
+    def query(self, tags:list[str]|None=None, where:dict[str, str]|None=None) -> int:
+        '''bitmap of the notes having all `tags` and matching all `where` conditions'''
+        self._flush()
+        bitmap = self.alive
+
+        for tag in tags or []:
+            bitmap &= self.tags.get(tag.lower().lstrip('#').strip('/'), 0)
+
+        for key, condition in (where or {}).items():
+            bitmap &= self._match(key, str(condition))
+
+        return bitmap
+
+    def facet(self, bitmap:int, key:str='tags', k:int=20) -> dict[str, int]:
+        '''number of matching notes per tag (or per value of a frontmatter key)'''
+        self._flush()
+        column = self.tags if key == 'tags' else self.props.get(key.lower(), {})
+
+        counts = ((value, (bits & bitmap).bit_count()) for value, bits in column.items())
+        return dict(sorted((c for c in counts if c[1]), key=lambda c:-c[1])[:k])
+
+    def paths_of(self, bitmap:int) -> Iterator[str]:
+        for doc_id in iter_bits(bitmap):
+            yield self.paths[doc_id]
+
+    def _dump(self) -> dict:
+        return {'paths':self.paths, 'docs':self.docs}
+
+    def _restore(self, state:dict):
+        self.paths = state['paths']
+        self.docs = state['docs']
+        self.path2id = {path:doc_id for doc_id, path in enumerate(self.paths) if path is not None}
+        self.free_ids = [doc_id for doc_id, path in enumerate(self.paths) if path is None]
+
+        # the bitmaps are rebuilt on the first query
+        self.tags, self.props, self.alive = {}, {}, 0
+        self._pending = list(self.docs)
@@ -0,0 +1,97 @@
+from typing import NamedTuple
+import re
+
+from .index import DocIndex
+
+HEADING_PATTERN = re.compile(r'^(#{1,6})[ \t]+(.*?)[ \t#]*$')
+FENCE_PATTERN = re.compile(r'^[ \t]{0,3}(```|~~~)')
+
+
+class Section(NamedTuple):
+    level: int
+    heading: str
+    start: int  # byte offset of the heading line
+    end: int    # byte offset where the next heading of the same or a higher level starts
+
+
+def parse_outline(text:str) -> list[Section]:
+    '''ATX headings of a markdown note with byte offsets (fenced code and frontmatter are skipped)'''
+    headings:list[tuple[int, str, int]] = []
+
+    offset = 0
+    fence = None
+    lines = text.splitlines(keepends=True)
+
+    for idx, line in enumerate(lines):
+        start = offset
+        offset += len(line.encode('utf-8'))
+
+        if idx == 0 and line.rstrip() == '---':
+            fence = '---'
+            continue
+
+        if fence == '---':
+            if line.rstrip() in ('---', '...'):
+                fence = None
+            continue
+
+        if m := FENCE_PATTERN.match(line):
+            if fence is None:
+                fence = m.group(1)
+            elif fence == m.group(1):
+                fence = None
+            continue
+
+        if fence is None and (m := HEADING_PATTERN.match(line.rstrip('\r\n'))):
+            headings.append((len(m.group(1)), m.group(2), start))
+
+    outline = []
+    for i, (level, heading, start) in enumerate(headings):
+        end = offset
+        for next_level, _, next_start in headings[i + 1:]:
+            if next_level <= level:
+                end = next_start
+                break
+
+        outline.append(Section(level, heading, start, end))
+
+    return outline
+
+
+class OutlineIndex(DocIndex):
+    '''heading outline per note, so a section can be served with a single seek+read'''
+    VERSION = 1
+
+    def __init__(self, index_path:str) -> None:
+        super().__init__(index_path)
+        self.outlines:dict[str, list[Section]] = {}
+
+    def get(self, rel_path:str) -> list[Section]:
+        return self.outlines.get(rel_path, [])
+
+    def find(self, rel_path:str, heading:str) -> Section | None:
+        '''exact (case-insensitive) heading match first, then a substring match'''
+        heading = heading.strip().lstrip('#').strip().lower()
+        outline = self.get(rel_path)
+
+        for section in outline:
+            if section.heading.lower() == heading:
+                return section
+
+        for section in outline:
+            if heading in section.heading.lower():
+                return section
+
+        return None
+
+    def _add(self, rel_path:str, text:str):
+        self.outlines[rel_path] = parse_outline(text)
+
+    def _remove(self, rel_path:str):
+        self.outlines.pop(rel_path, None)
+
+    def _dump(self) -> dict:
+        return {'outlines':{k:[tuple(s) for s in v] for k,v in self.outlines.items()}}
+
+    def _restore(self, state:dict):
+        self.outlines = {k:[Section(*s) for s in v] for k,v in state['outlines'].items()}
@@ -0,0 +1,282 @@
+from array import array
+from bisect import bisect_left
+import heapq
+import math
+import os
+import re
+
+from .index import DocIndex
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text:str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def snippet(text:str, terms:set[str], width:int=160) -> str:
+    '''a window of `width` characters around the first occurrence of any query term'''
+    pos = -1
+    for m in TOKEN_PATTERN.finditer(text):
+        if m.group().lower() in terms:
+            pos = m.start()
+            break
+
+    start = max(pos - width // 4, 0) if pos >= 0 else 0
+    window = ' '.join(text[start:start + width].split())
+
+    return f"...{window}" if start > 0 else window
+
+
+class SearchIndex(DocIndex):
+    '''
+    BM25 ranked full-text index
+
+    postings are kept per term as two parallel arrays (doc ids, term frequencies).
+    documents get a new id on every update, so the id arrays stay sorted by appending;
+    the previous id is tombstoned and the arrays are compacted once tombstones pile up.
+    document frequencies include tombstones until the next compaction.
+
+    a query only walks the posting lists of its rare terms; terms that occur in more than
+    1/16 of the notes are looked up by bisection for the candidate documents.
+    terms with more than CHAMPIONS postings keep a min-heap of their best postings, updated
+    as notes are added and rebuilt on compaction, so a query never scans a long posting list.
+    '''
+    VERSION = 2
+    CHAMPIONS = 256
+
+    def __init__(self, index_path:str, k1:float=1.2, b:float=0.75) -> None:
+        super().__init__(index_path)
+
+        self.k1:float = k1
+        self.b:float = b
+
+        self.postings:dict[str, tuple[array, array]] = {}
+        self.doc_paths:list[str | None] = []
+        self.doc_len:array = array('I')
+        self.path2id:dict[str, int] = {}
+
+        self.total_len:int = 0
+
+        # term -> min-heap of (weight, doc id) of its best postings (tombstones are skipped on read)
+        self.champions:dict[str, list[tuple[float, int]]] = {}
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.path2id)
+
+    def _weight(self, n:int, dl:int) -> float:
+        '''bm25 term weight without idf, with the average length at the time it is computed'''
+        avgdl = self.total_len / self.n_docs if self.n_docs else dl or 1
+        return n / (n + self.k1 * (1 - self.b + self.b * dl / avgdl))
+
+    def _build_champions(self, term:str) -> list[tuple[float, int]]:
+        ids, tfs = self.postings[term]
+        doc_paths, doc_len = self.doc_paths, self.doc_len
+
+        entries = [(self._weight(n, doc_len[doc_id]), doc_id) for doc_id, n in zip(ids, tfs) if doc_paths[doc_id] is not None]
+        top = heapq.nlargest(self.CHAMPIONS, entries)
+        heapq.heapify(top)
+
+        return top
+
+    def _add(self, rel_path:str, text:str):
+        doc_id = len(self.doc_paths)
+
+        # the note name is part of the searchable text
+        tokens = tokenize(os.path.splitext(os.path.basename(rel_path))[0])
+        tokens += tokenize(text)
+
+        tf:dict[str, int] = {}
+        for t in tokens:
+            tf[t] = tf.get(t, 0) + 1
+
+        for t, n in tf.items():
+            p = self.postings.get(t)
+            if p is None:
+                p = self.postings[t] = (array('I'), array('H'))
+
+            p[0].append(doc_id)
+            p[1].append(min(n, 0xFFFF))
+
+        self.doc_paths.append(rel_path)
+        self.doc_len.append(len(tokens))
+        self.path2id[rel_path] = doc_id
+        self.total_len += len(tokens)
+
+        for t, n in tf.items():
+            if len(self.postings[t][0]) <= self.CHAMPIONS:
+                continue
+
+            if (heap := self.champions.get(t)) is None:
+                self.champions[t] = self._build_champions(t)
+            elif len(heap) < self.CHAMPIONS:
+                heapq.heappush(heap, (self._weight(n, len(tokens)), doc_id))
+            else:
+                heapq.heappushpop(heap, (self._weight(n, len(tokens)), doc_id))
+
+    def _remove(self, rel_path:str):
+        doc_id = self.path2id.pop(rel_path)
+
+        self.doc_paths[doc_id] = None
+        self.total_len -= self.doc_len[doc_id]
+
+        n_dead = len(self.doc_paths) - self.n_docs
+        if n_dead > 1024 and n_dead > self.n_docs // 4:
+            self.compact()
+
+    def compact(self):
+        '''drop tombstoned documents and renumber the rest'''
+        remap = array('i', [-1]) * len(self.doc_paths)
+
+        doc_paths, doc_len = [], array('I')
+        for doc_id, path in enumerate(self.doc_paths):
+            if path is None:
+                continue
+
+            remap[doc_id] = len(doc_paths)
+            doc_paths.append(path)
+            doc_len.append(self.doc_len[doc_id])
+
+        postings = {}
+        for t, (ids, tfs) in self.postings.items():
+            new_ids, new_tfs = array('I'), array('H')
+            for doc_id, n in zip(ids, tfs):
+                if (new_id := remap[doc_id]) >= 0:
+                    new_ids.append(new_id)
+                    new_tfs.append(n)
+
+            if new_ids:
+                postings[t] = (new_ids, new_tfs)
+
+        self.postings = postings
+        self.doc_paths = doc_paths
+        self.doc_len = doc_len
+        self.path2id = {path:doc_id for doc_id, path in enumerate(doc_paths)}
+
+        # champions are renumbered, a list that lost too many to tombstones is rebuilt
+        champions = {}
+        for t, heap in self.champions.items():
+            if t not in postings or len(postings[t][0]) <= self.CHAMPIONS:
+                continue
+
+            heap = [(w, new_id) for w, doc_id in heap if (new_id := remap[doc_id]) >= 0]
+            if len(heap) < self.CHAMPIONS // 2:
+                heap = self._build_champions(t)
+            else:
+                heapq.heapify(heap)
+
+            champions[t] = heap
+
+        self.champions = champions
+
+    def search(self, query:str, k:int=10) -> list[tuple[str, float]]:
+        n_docs = self.n_docs
+        if not n_docs:
+            return []
+
+        k1, b = self.k1, self.b
+        avgdl = self.total_len / n_docs
+        doc_paths, doc_len = self.doc_paths, self.doc_len
+
+        # tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+        norm = k1 * (1 - b)
+        slope = k1 * b / avgdl
+
+        postings = [(t, p) for t in set(tokenize(query)) if (p := self.postings.get(t))]
+
+        # rare terms are scored over their whole posting list. very common terms (tiny idf)
+        # only re-score the candidates, which come from the rare terms or, for a query made
+        # of common terms only, from the per-term champion lists
+        common_df = max(n_docs // 16, self.CHAMPIONS)
+        rare = [p for _, p in postings if len(p[0]) <= common_df]
+        common = [(t, p) for t, p in postings if len(p[0]) > common_df]
+
+        scores:dict[int, float] = {}
+        for ids, tfs in rare:
+            df = min(len(ids), n_docs)
+            idf = math.log((n_docs + 1) / (df + 0.5))
+
+            for doc_id, n in zip(ids, tfs):
+                if doc_paths[doc_id] is None:
+                    continue
+
+                w = idf * n * (k1 + 1) / (n + norm + slope * doc_len[doc_id])
+                scores[doc_id] = scores.get(doc_id, 0.0) + w
+
+        if not scores and common:
+            return self._search_champions(common, k, norm, slope)
+
+        for _, (ids, tfs) in common:
+            df = min(len(ids), n_docs)
+            idf = math.log((n_docs + 1) / (df + 0.5))
+
+            for doc_id in scores:
+                i = bisect_left(ids, doc_id)
+                if i < len(ids) and ids[i] == doc_id:
+                    n = tfs[i]
+                    scores[doc_id] += idf * n * (k1 + 1) / (n + norm + slope * doc_len[doc_id])
+
+        top = heapq.nlargest(k, scores.items(), key=lambda x:x[1])
+        return [(doc_paths[doc_id], score) for doc_id, score in top]
+
+    def _search_champions(self, common:list[tuple[str, tuple[array, array]]], k:int, norm:float, slope:float) -> list[tuple[str, float]]:
+        '''
+        a query of common terms only: the champions of its terms are the candidates, scored in the
+        order of their upper bound (their champion weights, and the weakest champion of a term
+        they are not a champion of) until no remaining candidate can beat the k-th score.
+        common terms saturate, so the bounds are loose: at most CHAMPIONS candidates are scored,
+        the notes that are champions of several terms come first
+        '''
+        n_docs, k1 = self.n_docs, self.k1
+        doc_paths, doc_len = self.doc_paths, self.doc_len
+
+        terms, floor = [], 0.0
+        excess:dict[int, float] = {}
+        for t, (ids, tfs) in common:
+            idf = math.log((n_docs + 1) / (min(len(ids), n_docs) + 0.5)) * (k1 + 1)
+            terms.append((idf, ids, tfs))
+
+            heap = self.champions.get(t, [])
+            low = idf * heap[0][0] if heap else 0.0
+            floor += low
+
+            for w, doc_id in heap:
+                if doc_paths[doc_id] is not None:
+                    excess[doc_id] = excess.get(doc_id, 0.0) + idf * w - low
+
+        top:list[tuple[float, int]] = []
+        for doc_id, bound in heapq.nlargest(max(self.CHAMPIONS, k), excess.items(), key=lambda x:x[1]):
+            if len(top) == k and floor + bound <= top[0][0]:
+                break
+
+            score, dl = 0.0, doc_len[doc_id]
+            for idf, ids, tfs in terms:
+                i = bisect_left(ids, doc_id)
+                if i < len(ids) and ids[i] == doc_id:
+                    n = tfs[i]
+                    score += idf * n / (n + norm + slope * dl)
+
+            if len(top) < k:
+                heapq.heappush(top, (score, doc_id))
+            elif score > top[0][0]:
+                heapq.heappushpop(top, (score, doc_id))
+
+        return [(doc_paths[doc_id], score) for score, doc_id in sorted(top, reverse=True)]
+
+    def _dump(self) -> dict:
+        return {
+            'postings':self.postings,
+            'doc_paths':self.doc_paths,
+            'doc_len':self.doc_len,
+            'total_len':self.total_len,
+            'champions':self.champions,
+        }
+
+    def _restore(self, state:dict):
+        self.postings = state['postings']
+        self.doc_paths = state['doc_paths']
+        self.doc_len = state['doc_len']
+        self.total_len = state['total_len']
+        self.champions = state['champions']
+        self.path2id = {path:doc_id for doc_id, path in enumerate(self.doc_paths) if path is not None}
@@ -1,62 +1,577 @@
 from mcp.server.fastmcp import FastMCP
 from mcp.server.fastmcp.exceptions import *
-import glob, os
+from mcp.server.lowlevel import NotificationOptions
+from mcp.server.stdio import stdio_server
+from mcp import types
+from contextlib import asynccontextmanager
+from bisect import bisect_right
+from datetime import datetime
+import asyncio, anyio, weakref
+import fnmatch, importlib.metadata, os, time
 
 from .types import MarkdownResource
-from .utils import uri2path, path2uri
-from .config import VAULT_PATH
+from .index import VaultIndex, IndexChanges, DocIndex
+from .search import SearchIndex, tokenize, snippet
+from .outline import OutlineIndex
+from .graph import LinkIndex
+from .meta import MetaIndex
+from .watcher import BaseWatcher, create_watcher
+from .cache import content_cache
+from .utils import uri2path, path2uri, encode_cursor, decode_cursor
+from .config import VAULT_PATH, INDEX_DIR, WATCH_MODE, BATCH_READ_CONCURRENCY, BATCH_READ_MAX_BYTES, RESOURCE_PAGE_SIZE
 
 from mcp.server.fastmcp.server import logger
 
+MCP_VERSION = importlib.metadata.version('mcp')
+
+INDEX_SAVE_INTERVAL = 60 # seconds
+
+LIST_FIELDS = ('name', 'uri', 'path', 'size', 'mtime')
+
+# primary sort key of a doc (the relative path breaks ties)
+SORT_KEYS = {
+    'path':lambda rel_path, entry:rel_path,
+    'name':lambda rel_path, entry:os.path.basename(rel_path).split('.')[0].lower(),
+    'size':lambda rel_path, entry:entry.size,
+    '-size':lambda rel_path, entry:-entry.size,
+    'mtime':lambda rel_path, entry:entry.mtime_ns,
+    '-mtime':lambda rel_path, entry:-entry.mtime_ns,
+}
+
 class ObsidianVaultServer:
     def __init__(self):
-        self.app = FastMCP("obsidian-vault")
+        self.app = FastMCP("obsidian-vault", lifespan=self._lifespan)
 
         self.resource_map = {}
+        self.sessions = weakref.WeakSet()
+        self._unregister_warned = False
+
+        # sort option -> sorted [(primary key, relative path)], dropped on every vault change
+        self._listings:dict[str, list[tuple]] = {}
 
         self._init_resources()
         self._init_tools()
+        self._init_handlers()
 
     def _init_resources(self):
-        file_list = glob.glob(os.path.join(VAULT_PATH, '*/*/*.md'))
+        start = time.perf_counter()
+
+        self.index = VaultIndex(VAULT_PATH, os.path.join(INDEX_DIR, 'vault.json'))
+        warm = self.index.load()
+
+        # the server may have been stopped while notes were edited in place
+        changes = self.index.reconcile(stat_files=True)
+        if changes or not warm:
+            self.index.save()
 
         self.resource_map = {}
-        for path in file_list:
-            # Use relative path for vault portability
-            relative_path = os.path.relpath(path, start=VAULT_PATH)
-            uri = f"file:///{path2uri(relative_path)}"
-
-            rsrc = MarkdownResource(
-                uri=uri, #! It converts the whitespace to %20
-                name=os.path.basename(path).split('.')[0],
-                mime_type="text/markdown",
-                size=os.path.getsize(path)
+        for rel_path, entry in self.index.files.items():
+            self._add_resource(rel_path, entry.size)
+
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(
+            f"vault index {'warm' if warm else 'cold'} start: {len(self.resource_map)} docs in {elapsed:.1f} ms "
+            f"(+{len(changes.added)} ~{len(changes.modified)} -{len(changes.removed)})"
+        )
+
+        self._init_doc_indexes()
+
+    def _init_doc_indexes(self):
+        self.search = SearchIndex(os.path.join(INDEX_DIR, 'search.pickle'))
+        self.outline = OutlineIndex(os.path.join(INDEX_DIR, 'outline.pickle'))
+        self.links = LinkIndex(os.path.join(INDEX_DIR, 'links.pickle'))
+        self.meta = MetaIndex(os.path.join(INDEX_DIR, 'meta.pickle'))
+        self.doc_indexes:list[DocIndex] = [self.search, self.outline, self.links, self.meta]
+
+        start = time.perf_counter()
+        stale:dict[DocIndex, tuple[list[str], list[str], bool]] = {}
+        for idx in self.doc_indexes:
+            warm = idx.load()
+            outdated, removed = idx.stale(self.index)
+            for rel_path in removed:
+                idx.remove(rel_path)
+            stale[idx] = (outdated, removed, warm)
+
+        #* read every outdated note once and hand the text to each index that wants it
+        needed:dict[str, list[DocIndex]] = {}
+        for idx, (outdated, _, _) in stale.items():
+            for rel_path in outdated:
+                needed.setdefault(rel_path, []).append(idx)
+
+        for rel_path, indexes in needed.items():
+            try:
+                text = self._read_text(rel_path)
+            except OSError:
+                continue
+
+            digest = self.index.files[rel_path].digest
+            for idx in indexes:
+                idx.update(rel_path, digest, text)
+
+        for idx, (outdated, removed, warm) in stale.items():
+            if outdated or removed or not warm:
+                idx.save()
+
+            logger.info(
+                f"{type(idx).__name__} {'warm' if warm else 'cold'} start "
+                f"({len(outdated)} re-indexed, {len(removed)} dropped)"
             )
-            # Store using decoded URI for consistent lookup
-            decoded_uri = uri2path(uri)
-            self.resource_map[decoded_uri] = rsrc
-            self.app.add_resource(rsrc)
+
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(f"doc indexes ready in {elapsed:.1f} ms ({len(needed)} notes read)")
+
+        self._indexes_saved = time.monotonic()
+        self._indexes_dirty = False
+
+    def _read_text(self, rel_path:str) -> str:
+        # keep line endings as they are, the outline stores byte offsets
+        with open(self.index.abspath(rel_path), encoding='utf-8', errors='replace', newline='') as fd:
+            return fd.read()
+
+    def _save_indexes(self, force:bool=False):
+        # the startup reconcile re-stats every note and the doc indexes carry their own digests,
+        # so a lost save only costs a re-hash and re-index on the next start
+        if not self._indexes_dirty:
+            return
+
+        if not force and time.monotonic() - self._indexes_saved < INDEX_SAVE_INTERVAL:
+            return
+
+        self.index.save()
+        for idx in self.doc_indexes:
+            idx.save()
+
+        self._indexes_saved = time.monotonic()
+        self._indexes_dirty = False
+
+    def _add_resource(self, rel_path:str, size:int):
+        # Use relative path for vault portability
+        uri = f"file:///{path2uri(rel_path)}"
+
+        rsrc = MarkdownResource(
+            uri=uri, #! It converts the whitespace to %20
+            name=os.path.basename(rel_path).split('.')[0],
+            mime_type="text/markdown",
+            size=size
+        )
+        # Store using decoded URI for consistent lookup
+        decoded_uri = uri2path(uri)
+        self.resource_map[decoded_uri] = rsrc
+        self.app.add_resource(rsrc)
+
+    def _remove_resource(self, rel_path:str):
+        rsrc = self.resource_map.pop(f"file:///{rel_path}", None)
+        if rsrc:
+            self._unregister_resource(str(rsrc.uri))
+
+    def _unregister_resource(self, uri:str):
+        #! FastMCP has no public API for unregistering a resource, this relies on the resource manager of mcp 1.x
+        resources = getattr(getattr(self.app, '_resource_manager', None), '_resources', None)
+        if not isinstance(resources, dict):
+            if not self._unregister_warned:
+                logger.warning(f"cannot unregister resources with mcp {MCP_VERSION}, removed notes stay listed by FastMCP")
+                self._unregister_warned = True
+            return
+
+        resources.pop(uri, None)
+
+    def _apply_changes(self, changes:IndexChanges):
+        self._listings.clear()
+
+        for rel_path in changes.removed:
+            content_cache.invalidate(self.index.abspath(rel_path))
+            self._remove_resource(rel_path)
+
+            for idx in self.doc_indexes:
+                idx.remove(rel_path)
+
+        for rel_path in changes.modified + changes.added:
+            entry = self.index.files[rel_path]
+
+            content_cache.invalidate(self.index.abspath(rel_path))
+            self._remove_resource(rel_path)
+            self._add_resource(rel_path, entry.size)
+
+            try:
+                text = self._read_text(rel_path)
+            except OSError:
+                continue
+
+            for idx in self.doc_indexes:
+                idx.update(rel_path, entry.digest, text)
+
+        self._indexes_dirty = True
+
+    def _refresh_doc(self, rel_path:str):
+        '''re-check a single note before serving offsets from the doc indexes (no-op when unchanged)'''
+        status = self.index.update_file(rel_path)
+        if status is None:
+            return
+
+        changes = IndexChanges([], [], [])
+        getattr(changes, status).append(rel_path)
+
+        self._apply_changes(changes)
+        self._save_indexes()
+
+    def _get_resource(self, uri:str) -> MarkdownResource:
+        # Use uri2path for consistent URI handling
+        decoded_uri = uri2path(uri)
+        rsrc = self.resource_map.get(decoded_uri, None)
+        if not rsrc:
+            raise ValueError(f"Not a registered resource URI")
+
+        return rsrc
+
+    def _get_fresh_resource(self, uri:str) -> tuple[str, MarkdownResource]:
+        self._get_resource(uri)
+
+        rel_path = uri2path(uri)[len('file:///'):]
+        self._refresh_doc(rel_path)
+
+        return rel_path, self._get_resource(uri)
+
+    def _listing(self, sort:str) -> list[tuple]:
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort option({sort}), use one of {list(SORT_KEYS)}")
+
+        if (listing := self._listings.get(sort)) is None:
+            key = SORT_KEYS[sort]
+            listing = sorted((key(k, v), k) for k,v in self.index.files.items())
+            self._listings[sort] = listing
+
+        return listing
+
+    def _page(self, sort:str, cursor:str|None, limit:int, accept=None) -> tuple[list[str], str|None]:
+        '''
+        one page of relative paths in `sort` order, starting after `cursor`
+        the cursor is the sort key of the last returned doc, so pages stay consistent while the vault changes
+        '''
+        listing = self._listing(sort)
+
+        start = 0
+        if cursor:
+            cursor_sort, *key = decode_cursor(cursor)
+            if cursor_sort != sort:
+                raise ValueError(f"Cursor was created for sort({cursor_sort})")
+            start = bisect_right(listing, tuple(key))
+
+        page = []
+        for item in listing[start:] if accept else listing[start:start + limit + 1]:
+            if accept and not accept(item[1]):
+                continue
+
+            if len(page) == limit:
+                return [rel_path for _, rel_path in page], encode_cursor([sort, *page[-1]])
+
+            page.append(item)
+
+        return [rel_path for _, rel_path in page], None
+
+    def _init_handlers(self):
+        # wrap the FastMCP handlers to remember client sessions for list-changed notifications
+        server = self.app._mcp_server
+
+        async def list_resources(req:types.ListResourcesRequest):
+            self._remember_session()
+
+            #! mcp 1.6 puts the cursor on the request, later versions on the params
+            cursor = getattr(req, 'cursor', None) or getattr(req.params, 'cursor', None)
+            page, next_cursor = self._page('path', cursor, RESOURCE_PAGE_SIZE)
+
+            resources = [self.resource_map[f"file:///{rel_path}"] for rel_path in page]
+            if not cursor:
+                # resources that are not vault docs (e.g. stats) go on the first page
+                resources = [
+                    r for r in self.app._resource_manager.list_resources() if not isinstance(r, MarkdownResource)
+                ] + resources
+
+            return types.ServerResult(types.ListResourcesResult(
+                resources=[
+                    types.Resource(uri=r.uri, name=r.name or "", description=r.description, mimeType=r.mime_type)
+                    for r in resources
+                ],
+                nextCursor=next_cursor,
+            ))
+
+        # the low-level decorator of mcp 1.6 does not pass the cursor through
+        server.request_handlers[types.ListResourcesRequest] = list_resources
+
+        @server.call_tool()
+        async def call_tool(name, arguments):
+            self._remember_session()
+            return await self.app.call_tool(name, arguments)
+
+    def _remember_session(self):
+        try:
+            self.sessions.add(self.app._mcp_server.request_context.session)
+        except LookupError:
+            pass
+
+    async def _notify_resource_list_changed(self):
+        for session in list(self.sessions):
+            try:
+                await session.send_resource_list_changed()
+            except Exception as e:
+                logger.warning(f"failed to send resource list changed notification: {e}")
+                self.sessions.discard(session)
+
+    async def _apply_batch(self, watcher:BaseWatcher, touched:set[str]):
+        changes = self.index.reconcile_paths(touched)
+
+        watcher.refresh()
+        if not changes:
+            return
+
+        self._apply_changes(changes)
+        self._save_indexes()
+
+        logger.info(f"vault changed (+{len(changes.added)} ~{len(changes.modified)} -{len(changes.removed)})")
+        await self._notify_resource_list_changed()
+
+    async def _watch(self):
+        watcher = create_watcher(self.index, WATCH_MODE)
+        logger.info(f"watching vault with {type(watcher).__name__}")
+
+        try:
+            async for touched in watcher.batches():
+                try:
+                    await self._apply_batch(watcher, touched)
+                except Exception as e:
+                    # one failed batch must not stop the vault from being refreshed
+                    logger.exception(f"failed to apply vault changes ({e!r})")
+        finally:
+            watcher.close()
+
+    @asynccontextmanager
+    async def _lifespan(self, app:FastMCP):
+        task = asyncio.create_task(self._watch()) if WATCH_MODE != 'off' else None
+        try:
+            yield {}
+        finally:
+            if task:
+                task.cancel()
+
+            self._save_indexes(force=True)
+            logger.info(f"content cache stats: {content_cache.stats()}")
 
     def _init_tools(self):
 
+        @self.app.resource("stats://content-cache", name="content-cache-stats", mime_type="application/json")
+        def content_cache_stats() -> dict:
+            '''hit/miss/eviction counters of the server-wide content cache'''
+            return content_cache.stats()
+
         @self.app.tool()
-        async def list_docs() -> list[dict[str, str]]:
-            '''List the names and URIs of all docs written in the the vault
+        async def list_docs(
+            folder:str='', name:str='', sort:str='path', fields:list[str]|None=None, limit:int=100, cursor:str=''
+        ) -> dict:
+            '''List the docs written in the vault, one page at a time.
+            folder: only docs under this folder, name: glob pattern on the doc name (e.g. "*python*"),
+            sort: path | name | size | -size | mtime | -mtime, fields: subset of name, uri, path, size, mtime.
+            pass `next_cursor` of the result as `cursor` to get the next page
             '''
-            return [{'name':rsrc.name, 'uri':rsrc.uri, 'size':rsrc.size} for rsrc in self.resource_map.values()]
+            fields = fields or ['name', 'uri', 'size']
+            if unknown := set(fields) - set(LIST_FIELDS):
+                raise ValueError(f"Unknown fields({sorted(unknown)}), use any of {list(LIST_FIELDS)}")
+
+            prefix = f"{folder.strip('/')}/" if folder.strip('/') else ''
+            pattern = name.lower()
+
+            def accept(rel_path:str) -> bool:
+                if not rel_path.startswith(prefix):
+                    return False
+
+                return not pattern or fnmatch.fnmatchcase(os.path.basename(rel_path).split('.')[0].lower(), pattern)
+
+            page, next_cursor = self._page(sort, cursor, max(1, min(limit, 1000)), accept if prefix or pattern else None)
+
+            docs = []
+            for rel_path in page:
+                rsrc = self.resource_map[f"file:///{rel_path}"]
+                entry = self.index.files[rel_path]
+                doc = {'name':rsrc.name, 'uri':rsrc.uri, 'path':rel_path, 'size':entry.size, 'mtime':int(entry.mtime_ns // 10**9)}
+                docs.append({k:doc[k] for k in fields})
+
+            return {'docs':docs, 'next_cursor':next_cursor}
 
         @self.app.tool()
         async def get_doc_by_uri(uri:str) -> str:
             '''get contents of the docs resource by uri
             '''
-            # Use uri2path for consistent URI handling
-            decoded_uri = uri2path(uri)
-            rsrc = self.resource_map.get(decoded_uri, None)
-            if not rsrc:
-                raise ValueError(f"Not a registered resource URI")
-
+            rsrc = self._get_resource(uri)
             return await rsrc.read()
 
+        @self.app.tool()
+        async def get_docs_by_uris(uris:list[str]) -> list[dict]:
+            '''get contents of several docs at once. returns one entry per uri in the same order,
+            either {uri, contents} or {uri, error}
+            '''
+            semaphore = asyncio.Semaphore(BATCH_READ_CONCURRENCY)
+
+            async def read(uri:str, rsrc:MarkdownResource) -> dict:
+                async with semaphore:
+                    try:
+                        return {'uri':uri, 'contents':await rsrc.read()}
+                    except Exception as e:
+                        return {'uri':uri, 'error':str(e)}
+
+            async def failed(uri:str, error:str) -> dict:
+                return {'uri':uri, 'error':error}
+
+            # the byte budget is assigned in request order from the indexed sizes, before reading
+            total = 0
+            jobs = []
+            for uri in uris:
+                try:
+                    rsrc = self._get_resource(uri)
+                except ValueError as e:
+                    jobs.append(failed(uri, str(e)))
+                    continue
+
+                if total + rsrc.size > BATCH_READ_MAX_BYTES:
+                    jobs.append(failed(uri, f"total size limit({BATCH_READ_MAX_BYTES} bytes) exceeded, request it separately"))
+                    continue
+
+                total += rsrc.size
+                jobs.append(read(uri, rsrc))
+
+            return await asyncio.gather(*jobs)
+
+        @self.app.tool()
+        async def get_doc_outline(uri:str) -> list[dict]:
+            '''get the heading outline of a doc by uri. each heading has its level, byte offset and length
+            '''
+            rel_path, _ = self._get_fresh_resource(uri)
+
+            return [
+                {'level':s.level, 'heading':s.heading, 'offset':s.start, 'length':s.end - s.start}
+                for s in self.outline.get(rel_path)
+            ]
+
+        @self.app.tool()
+        async def get_doc_section(uri:str, heading:str='', offset:int=0, length:int=0) -> str:
+            '''get a part of a doc by uri, either the section under `heading` or `length` bytes from `offset`.
+            use get_doc_outline to find headings and offsets
+            '''
+            rel_path, rsrc = self._get_fresh_resource(uri)
+
+            if heading:
+                section = self.outline.find(rel_path, heading)
+                if not section:
+                    raise ValueError(f"No section with heading({heading})")
+
+                offset, end = section.start, section.end
+                if length > 0:
+                    end = min(end, offset + length)
+            else:
+                if offset < 0:
+                    raise ValueError(f"offset({offset}) must not be negative")
+
+                size = self.index.files[rel_path].size
+                offset = min(offset, size)
+                end = min(offset + length, size) if length > 0 else size
+
+            return await rsrc.read_range(offset, max(end - offset, 0))
+
+        def doc_refs(rel_paths:list[str]) -> list[dict]:
+            return [
+                {'name':rsrc.name, 'uri':rsrc.uri}
+                for rel_path in rel_paths if (rsrc := self.resource_map.get(f"file:///{rel_path}"))
+            ]
+
+        @self.app.tool()
+        async def get_outlinks(uri:str) -> list[dict]:
+            '''get the docs linked from a doc ([[wikilinks]], embeds and markdown links) by uri
+            '''
+            self._get_resource(uri)
+            return doc_refs(self.links.outlinks(uri2path(uri)[len('file:///'):]))
+
+        @self.app.tool()
+        async def get_backlinks(uri:str) -> list[dict]:
+            '''get the docs linking to a doc by uri
+            '''
+            self._get_resource(uri)
+            return doc_refs(self.links.backlinks(uri2path(uri)[len('file:///'):]))
+
+        @self.app.tool()
+        async def related_docs(uri:str, depth:int=2, k:int=10) -> list[dict]:
+            '''get the docs most closely connected to a doc through links, up to `depth` hops away
+            '''
+            self._get_resource(uri)
+
+            results = []
+            for rel_path, score in self.links.related(uri2path(uri)[len('file:///'):], depth=min(depth, 4), k=k):
+                if rsrc := self.resource_map.get(f"file:///{rel_path}"):
+                    results.append({'name':rsrc.name, 'uri':rsrc.uri, 'score':round(score, 4)})
+
+            return results
+
+        @self.app.tool()
+        async def query_docs(
+            tags:list[str]|None=None, where:dict[str, str]|None=None, modified_after:str='', facet:str='', limit:int=50
+        ) -> dict:
+            '''Find docs by tags and frontmatter without reading them.
+            tags: docs having all of these tags (a parent tag like "project" also matches "project/x"),
+            where: frontmatter conditions such as {"status": "done", "created": ">=2024-01-01"} (=, !=, >, >=, <, <=),
+            modified_after: ISO date, facet: "tags" or a frontmatter key to count the matching docs per value
+            '''
+            bitmap = self.meta.query(tags=tags, where=where)
+            paths = self.meta.paths_of(bitmap)
+
+            if modified_after:
+                after_ns = int(datetime.fromisoformat(modified_after).timestamp() * 10**9)
+                paths = [p for p in paths if p in self.index.files and self.index.files[p].mtime_ns > after_ns]
+
+            docs, total = [], 0
+            for rel_path in paths:
+                rsrc = self.resource_map.get(f"file:///{rel_path}")
+                if not rsrc:
+                    continue
+
+                total += 1
+                if len(docs) < limit:
+                    docs.append({'name':rsrc.name, 'uri':rsrc.uri})
+
+            result = {'total':total, 'docs':docs}
+            if facet:
+                # the facet counts ignore modified_after, they come straight from the bitmaps
+                result['facets'] = self.meta.facet(bitmap, facet)
+
+            return result
+
+        @self.app.tool()
+        async def search_docs(query:str, k:int=10) -> list[dict]:
+            '''Search the docs in the vault by keywords. returns the best matching docs (name, uri, score, snippet)
+            '''
+            terms = set(tokenize(query))
+
+            results = []
+            for rel_path, score in self.search.search(query, k):
+                rsrc = self.resource_map.get(f"file:///{rel_path}")
+                if not rsrc:
+                    continue
+
+                results.append({
+                    'name':rsrc.name,
+                    'uri':rsrc.uri,
+                    'score':round(score, 3),
+                    'snippet':snippet(await rsrc.read(), terms),
+                })
+
+            return results
+
+    async def run_stdio_async(self):
+        server = self.app._mcp_server
+
+        async with stdio_server() as (read_stream, write_stream):
+            await server.run(
+                read_stream,
+                write_stream,
+                # clients cache tool results only from servers announcing change notifications, so only announce them when watching
+                server.create_initialization_options(NotificationOptions(resources_changed=WATCH_MODE != 'off')),
+            )
+
     def run(self):
-        self.app.run(transport='stdio')
+        anyio.run(self.run_stdio_async)
 
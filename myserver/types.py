@@ -3,24 +3,45 @@ import os
 import aiofiles
 
 from .config import VAULT_PATH
+from .cache import content_cache
 from .utils import uri2path
 
 class MarkdownResource(Resource):
     size: int = -1
 
-    async def read(self) -> str | bytes:
+    @property
+    def file_path(self) -> str:
         uri = uri2path(str(self.uri))
         
         if not uri.startswith("file:///"):
             raise ValueError(f"Only file:/// URI format supported. got uri({uri})")
         
         path = uri[len('file:///'):]
-        file_path = os.path.join(VAULT_PATH, path)
+        return os.path.join(VAULT_PATH, path)
+
+    async def read(self) -> str | bytes:
+        file_path = self.file_path
+
+        try:
+            data = await content_cache.read(file_path)
+        except FileNotFoundError:
+            raise ValueError(f"file_path({file_path}) not exists")
+
+        # same newline handling as a text mode read
+        return data.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n')
+
+    async def read_range(self, offset:int, length:int) -> str:
+        '''read `length` bytes from the byte `offset` (a cut multi-byte character is dropped)'''
+        file_path = self.file_path
+
+        if (data := content_cache.peek(file_path)) is not None:
+            return data[offset:offset + length].decode('utf-8', errors='ignore')
 
         if not os.path.exists(file_path):
             raise ValueError(f"file_path({file_path}) not exists")
-        
-        async with aiofiles.open(file_path, 'r') as fd:
-            contents = await fd.read()
 
-        return contents
\ No newline at end of file
+        async with aiofiles.open(file_path, 'rb') as fd:
+            await fd.seek(offset)
+            data = await fd.read(length)
+
+        return data.decode('utf-8', errors='ignore')
\ No newline at end of file
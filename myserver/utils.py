@@ -1,5 +1,6 @@
 
 from urllib.parse import unquote, quote
+import base64, json
 
 def uri2path(s):
     """Convert URI to file path, properly handling URL encoding/decoding"""
@@ -8,3 +9,14 @@ def uri2path(s):
 def path2uri(path):
     """Convert file path to URI, properly handling URL encoding"""
     return quote(path, safe='/')  # Keep slashes unencoded for proper URI format
+
+
+def encode_cursor(key) -> str:
+    """Encode a keyset pagination position as an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(key, ensure_ascii=False).encode()).decode()
+
+def decode_cursor(cursor:str) -> list:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError(f"Invalid cursor({cursor})")
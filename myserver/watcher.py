@@ -0,0 +1,191 @@
+from typing import AsyncIterator
+import abc
+import asyncio
+import ctypes, ctypes.util
+import os, struct, sys
+
+from .index import VaultIndex, DirRecord
+
+from mcp.server.fastmcp.server import logger
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = 0o0004000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class BaseWatcher(abc.ABC):
+    '''
+    watches the vault and yields batches of touched relative paths (notes or folders)
+    the server reconciles the index with each batch, so a watcher only has to say *where* something happened
+    '''
+    def __init__(self, index:VaultIndex) -> None:
+        self.index:VaultIndex = index
+
+    def refresh(self):
+        '''called after the index was reconciled (new folders may need to be watched)'''
+        pass
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def batches(self) -> AsyncIterator[set[str]]:
+        ...
+
+
+class InotifyWatcher(BaseWatcher):
+    def __init__(self, index:VaultIndex, debounce:float=0.2, max_delay:float=2.0) -> None:
+        super().__init__(index)
+
+        self.debounce:float = debounce
+        self.max_delay:float = max_delay
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd:int = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._wd2dir:dict[int, str] = {}
+        self._dir2wd:dict[str, int] = {}
+
+        self._pending:set[str] = set()
+        self._wakeup = asyncio.Event()
+
+        self.refresh()
+
+    def _add_watch(self, rel_dir:str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(self.index.abspath(rel_dir)), WATCH_MASK)
+        if wd < 0:
+            logger.warning(f"cannot watch folder({rel_dir}): {os.strerror(ctypes.get_errno())}")
+            return
+
+        self._wd2dir[wd] = rel_dir
+        self._dir2wd[rel_dir] = wd
+
+    def refresh(self):
+        for rel_dir in self.index.dirs:
+            if rel_dir not in self._dir2wd:
+                self._add_watch(rel_dir)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _on_readable(self):
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            name = buf[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, re-check every known note
+                self._pending.update(self.index.files)
+                continue
+
+            rel_dir = self._wd2dir.get(wd)
+            if rel_dir is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self._wd2dir[wd]
+                self._dir2wd.pop(rel_dir, None)
+                continue
+
+            name = os.fsdecode(name)
+            if name.startswith('.'):
+                continue
+
+            self._pending.add(f"{rel_dir}/{name}" if rel_dir and name else rel_dir or name)
+
+        if self._pending:
+            self._wakeup.set()
+
+    async def batches(self) -> AsyncIterator[set[str]]:
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self._fd, self._on_readable)
+
+        try:
+            while True:
+                await self._wakeup.wait()
+
+                # debounce: wait until the burst settles (or max_delay passed)
+                deadline = loop.time() + self.max_delay
+                while loop.time() < deadline:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=self.debounce)
+                    except asyncio.TimeoutError:
+                        break
+
+                self._wakeup.clear()
+                batch, self._pending = self._pending, set()
+                yield batch
+        finally:
+            loop.remove_reader(self._fd)
+
+
+class PollingWatcher(BaseWatcher):
+    '''
+    polls the folder mtimes like the index reconcile does, so notes added, removed or renamed are seen.
+    a note edited in place does not change its folder mtime, it is re-checked when it is read
+    '''
+    def __init__(self, index:VaultIndex, interval:float=2.0) -> None:
+        super().__init__(index)
+        self.interval:float = interval
+
+    def _poll(self, dirs:list[tuple[str, DirRecord]]) -> set[str]:
+        '''runs on a thread, so it works on a snapshot of the index taken on the event loop'''
+        touched = set()
+
+        for rel_dir, record in dirs:
+            try:
+                if os.stat(self.index.abspath(rel_dir)).st_mtime_ns != record.mtime_ns:
+                    touched.add(rel_dir)
+            except OSError:
+                touched.add(rel_dir)
+
+        return touched
+
+    async def batches(self) -> AsyncIterator[set[str]]:
+        while True:
+            await asyncio.sleep(self.interval)
+
+            if touched := await asyncio.to_thread(self._poll, list(self.index.dirs.items())):
+                yield touched
+
+
+def create_watcher(index:VaultIndex, mode:str='auto', **kwargs) -> BaseWatcher:
+    '''mode: auto | inotify | poll'''
+    if mode in ('auto', 'inotify') and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(index, **kwargs)
+        except OSError as e:
+            logger.warning(f"inotify unavailable ({e}), falling back to polling")
+
+    elif mode == 'inotify':
+        logger.warning("inotify is only available on linux, falling back to polling")
+
+    return PollingWatcher(index)
@@ -1,25 +1,39 @@
 from myagent import Agent, LlamaCPP, LlamaPrompt
+from myagent.cache import ToolResultCache, VAULT_READ_TOOLS, CACHE_TOOL_RESULTS
+from myagent.prefetch import RetrievalPrefetch, PREFETCH_DOCS
 import asyncio
+import signal
 
 async def run_agent():
     # model = LlamaCPP.from_path('./models/llama-8b-v3.1-F16.gguf')
     model = LlamaCPP.from_path('./models/llama-3.2-3B-Instruct.gguf')
     prompt = LlamaPrompt()
-    agent = Agent(name="knowledge-agent", model=model, prompt=prompt)
+    agent = Agent(name="knowledge-agent", model=model, prompt=prompt, tool_cache=ToolResultCache(tools=VAULT_READ_TOOLS) if CACHE_TOOL_RESULTS else None, prefetch=RetrievalPrefetch() if PREFETCH_DOCS else None)
 
     agent.register_mcp(path="./run_server.py")
 
+    loop = asyncio.get_running_loop()
+
     async with agent:
         while (prompt := input('(prompt) ')) != 'bye':
-            response = await agent.chat(prompt)
+            print("(assistant) ", end='', flush=True)
 
-            for r in response:
-                if r.type == 'text':
-                    print(f"(assistant) {r.data}")
-                elif r.type == 'tool-calling':
-                    print(f"(assistant) tool calling {r.data}")
-                elif r.type == 'tool-result':
-                    print(f"(assistant) tool result {r.data}")
+            # ctrl+c stops the answer being generated instead of the agent
+            loop.add_signal_handler(signal.SIGINT, agent.cancel)
+            try:
+                async for r in agent.chat_stream(prompt):
+                    if r.type == 'text':
+                        if r.partial:
+                            print(r.data, end='', flush=True)
+                        else:
+                            print()
+                    elif r.type == 'tool-calling':
+                        print(f"tool calling {r.data}")
+                    elif r.type == 'tool-result':
+                        print(f"(assistant) tool result {r.data}")
+                        print("(assistant) ", end='', flush=True)
+            finally:
+                loop.remove_signal_handler(signal.SIGINT)
 
 if __name__ == '__main__':
     asyncio.run(run_agent())
@@ -0,0 +1,113 @@
+import random
+import time
+
+import pytest
+
+from myagent.toolcall import parse_tool_calls, ToolCallSyntaxError, MAX_DEPTH
+
+
+def parse_or_error(text:str):
+    try:
+        return parse_tool_calls(text)
+    except ToolCallSyntaxError as e:
+        return e
+
+
+def test_plain_answers_are_not_calls():
+    assert parse_tool_calls('The note says hello.') is None
+    assert parse_tool_calls('[1] is a footnote') is None
+    assert parse_tool_calls('') is None
+
+
+def test_calls():
+    assert parse_tool_calls('[get_doc_by_uri(uri="file:///a/b, c=d.md")]') == [('get_doc_by_uri', {'uri':'file:///a/b, c=d.md'})]
+    assert parse_tool_calls("[search_docs(query='it\\'s \"quoted\"', k=5), list_docs(sort=\"-mtime\", limit=10,)] trailing") == [
+        ('search_docs', {'query':'it\'s "quoted"', 'k':5}),
+        ('list_docs', {'sort':'-mtime', 'limit':10}),
+    ]
+
+
+def test_nested_values():
+    calls = parse_tool_calls('[query_docs(tags=["a/b", "c"], where={"status": "done", n: -1.5e3, deep: [[{}]]}, ok=true)]')
+    assert calls == [('query_docs', {'tags':['a/b', 'c'], 'where':{'status':'done', 'n':-1500.0, 'deep':[[{}]]}, 'ok':True})]
+
+    assert parse_tool_calls('[f(a=' + '[' * (MAX_DEPTH - 1) + ']' * (MAX_DEPTH - 1) + ')]') is not None
+    with pytest.raises(ToolCallSyntaxError, match="too deeply nested"):
+        parse_tool_calls('[f(a=' + '[' * (MAX_DEPTH + 1) + ']' * (MAX_DEPTH + 1) + ')]')
+
+
+@pytest.mark.parametrize('text, message', [
+    ('[f(a="x', "unterminated string"),
+    ('[f(a="x"', "expected ',' or ')'"),
+    ('[f(a=1 b=2)]', "expected ',' or ')'"),
+    ('[f(=1)]', "expected a name"),
+    ('[f(a)]', "expected '='"),
+    ('[f(a=1.2.3)]', "bad number"),
+    ('[f(a="\\uZZZZ")]', "bad unicode escape"),
+    ('[]', None),
+])
+def test_malformed_calls(text, message):
+    result = parse_or_error(text)
+    if message is None:
+        assert result is None
+    else:
+        assert isinstance(result, ToolCallSyntaxError) and message in str(result)
+
+
+def test_fuzzed_calls_parse_or_raise():
+    '''random mutations of valid calls only ever parse or raise ToolCallSyntaxError'''
+    rng = random.Random(0)
+    samples = [
+        '[get_doc_by_uri(uri="file:///a/b, c=d.md")]',
+        "[search_docs(query='it\\'s \"quoted\"', k=5), list_docs(sort=\"-mtime\", limit=10)]",
+        '[query_docs(tags=["a/b", "c"], where={"status": "done", n: -1.5e3})]',
+    ]
+    alphabet = '[](){}=,"\'\\ -_.:aZ09'
+
+    for _ in range(5000):
+        text = list(rng.choice(samples))
+        for _ in range(rng.randint(1, 4)):
+            i = rng.randrange(len(text))
+            op = rng.random()
+            if op < 0.4:
+                text[i] = rng.choice(alphabet)
+            elif op < 0.7:
+                text.insert(i, rng.choice(alphabet))
+            else:
+                del text[i]
+
+        result = parse_or_error(''.join(text))
+        assert result is None or isinstance(result, (list, ToolCallSyntaxError))
+        if isinstance(result, list):
+            assert all(isinstance(name, str) and isinstance(params, dict) for name, params in result)
+
+
+ADVERSARIAL = {
+    'unterminated string':lambda n:'[f(a="' + 'x' * n,
+    'many arguments':lambda n:'[f(' + 'a=1,' * (n // 4) + ')]',
+    'many calls':lambda n:'[' + 'f(),' * (n // 4) + ']',
+    'long list':lambda n:'[f(a=[' + '[1],' * (n // 4),
+    'deep nesting':lambda n:'[f(a=' + '[' * n,
+    'equals and commas':lambda n:'[f(a=' + '=,' * (n // 2) + ')]',
+    'missing paren':lambda n:'[f(a="x"' + ' ' * n,
+}
+
+
+def per_char(text:str) -> float:
+    '''best of 3, in seconds per character'''
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        parse_or_error(text)
+        best = min(best, time.perf_counter() - start)
+
+    return best / len(text)
+
+
+@pytest.mark.parametrize('name', ADVERSARIAL)
+def test_parse_time_is_linear(name):
+    make = ADVERSARIAL[name]
+    small, large = per_char(make(1 << 12)), per_char(make(1 << 18))
+
+    # 64 times the input, the time per character stays within a small factor (quadratic would be 64x)
+    assert large < max(small, 1e-7) * 8
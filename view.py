@@ -1,7 +1,13 @@
 import streamlit as st
 import glob
-from myagent import Agent, LlamaCPP, LlamaPrompt
+from myagent import Agent, LlamaPrompt
+from myagent.cache import ToolResultCache, VAULT_READ_TOOLS, CACHE_TOOL_RESULTS
+from myagent.prefetch import RetrievalPrefetch, PREFETCH_DOCS
+from myagent.service import AgentService
+from myagent.registry import registry
+from myagent import errors
 import asyncio
+import threading
 import os
 
 MODEL_PATH = './models'
@@ -10,28 +16,84 @@ server_path = [
     './run_server.py'
 ]
 
-if "loop" not in st.session_state:
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        print('LOOP CREATED')
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+#* loaded models may take this much memory together, the least recently used are unloaded beyond it
+MODEL_MEMORY_BYTES = int(os.environ.get('MODEL_MEMORY_BYTES', 24 * 1024**3))
+
+@st.cache_resource
+def get_loop() -> asyncio.AbstractEventLoop:
+    '''event loop of the services, running on its own thread'''
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='agent-service', daemon=True).start()
+
+    return loop
+
+@st.cache_resource
+def get_services() -> tuple[dict[str, AgentService], threading.Lock]:
+    '''services by model name, one per process, shared by every browser session'''
+    services = {}
+
+    def evicted(path:str):
+        if service := services.pop(os.path.basename(path), None):
+            asyncio.run_coroutine_threadsafe(service.close(), get_loop())
+
+    registry.max_bytes = MODEL_MEMORY_BYTES
+    registry.on_evict.append(evicted)
+
+    return services, threading.Lock()
+
+def get_service(model_name:str) -> AgentService:
+    services, lock = get_services()
+
+    with lock:
+        if service := services.get(model_name):
+            return service
+
+        model = registry.get(os.path.join(MODEL_PATH, model_name))
+        agent = Agent(name="knowledge-agent", model=model, prompt=LlamaPrompt(), tool_cache=ToolResultCache(tools=VAULT_READ_TOOLS) if CACHE_TOOL_RESULTS else None, prefetch=RetrievalPrefetch() if PREFETCH_DOCS else None)
+
+        for path in server_path:
+            agent.register_mcp(path=path)
 
-    st.session_state.loop = loop
+        service = AgentService(agent)
+        asyncio.run_coroutine_threadsafe(service.start(), get_loop()).result()
+
+        services[model_name] = service
+        return service
+
+def run(coro):
+    '''runs a coroutine on the service loop and waits for its result'''
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-if "agent" not in st.session_state:
-    st.session_state.agent = None
+if "service" not in st.session_state:
+    st.session_state.service = None
+    st.session_state.session_id = None
+
+if st.session_state.service and st.session_state.service not in get_services()[0].values():
+    # the model was unloaded to make room for another one
+    st.session_state.service = None
+    st.session_state.session_id = None
 
 if "llm_param" not in st.session_state:
     st.session_state.llm_param = {}
 
 def generate_response(user_input):
-    response_list = st.session_state.loop.run_until_complete(st.session_state.agent.chat(user_input, **st.session_state.llm_param))
-    return response_list
+    '''drives the async chat stream on the service loop, one event at a time'''
+    # the session is opened again if it expired while idle
+    st.session_state.session_id = st.session_state.service.open_session(st.session_state.session_id)
+    stream = st.session_state.service.chat_stream(st.session_state.session_id, user_input, **st.session_state.llm_param)
+
+    try:
+        while True:
+            try:
+                yield run(stream.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        # a rerun (or the stop button) interrupts the script, this also stops the model
+        run(stream.aclose())
     
 st.subheader("🛠️ LLM Parameters")
 
@@ -58,26 +120,28 @@ st.session_state.llm_param['min_p'] = min_p
 st.session_state.llm_param['frequency_penalty'] = frequency_penalty
 st.session_state.llm_param['repeat_penalty'] = repeat_penalty
 
-if st.button("Load", use_container_width=True):
-    if not st.session_state.agent:
-        model_path = os.path.join(MODEL_PATH, model_name)
-        model = LlamaCPP.from_path(model_path)
-        prompt = LlamaPrompt()
-
-        agent = Agent(name="knowledge-agent", model=model, prompt=prompt)
+if model_name and not st.session_state.service and st.session_state.get('warmed_up') != model_name:
+    # the selected model is loaded in the background while the parameters are set,
+    # once per selection and not on every rerun
+    st.session_state.warmed_up = model_name
+    registry.warm_up(os.path.join(MODEL_PATH, model_name))
 
-        for path in server_path:
-            agent.register_mcp(path=path)
-
-        st.session_state.loop.run_until_complete(agent.init_agent())
+if st.button("Load", use_container_width=True):
+    if not st.session_state.service:
+        service = get_service(model_name)
 
-        st.session_state.agent = agent
+        st.session_state.service = service
+        st.session_state.session_id = service.open_session()
 
 with st.container():
-    agent = st.session_state.agent
+    agent = st.session_state.service.agent if st.session_state.service else None
     agent_name = f"`{agent.name}`" if agent else ""
     model_name = f"`{agent.model_name}`" if agent else ""
     status = '🟢 Ready' if agent else '🔴 Not Ready'
+
+    # load time and resident memory of the model, from the process-wide registry
+    model_stats = next((m for m in registry.stats() if agent and m['name'] == agent.model_name), None)
+    memory = f"{(model_stats['file_bytes'] + model_stats['rss_bytes']) / 1024**3:.1f}GiB, loaded in {model_stats['load_time']:.1f}s" if model_stats else ""
     server_list_html = "\n".join([f"\t- `{server_name}`" for server_name in agent.server_list]) if agent else ""
 
     tool_info = []
@@ -94,6 +158,7 @@ with st.container():
         st.markdown(f"""
         - **Agent**: {agent_name}
         - **Model**: {model_name}
+        - **Memory**: {memory}
         - **Status**: {status}
         - **MCP Server**:
         {server_list_html}
@@ -117,27 +182,40 @@ for i, msg in enumerate(st.session_state.messages):
         st.chat_message("assistant").markdown(content)
 
 # Chat input
-if user_input := st.chat_input("Type your message...", disabled=False if st.session_state.agent else True):
+if user_input := st.chat_input("Type your message...", disabled=False if st.session_state.service else True):
     # Add user message
     st.session_state.messages.append({"role": "user", "content": user_input})
     st.chat_message("user").markdown(user_input)
 
     # Generate response
-    with st.spinner("Generating Response ..."):
-        response_list = generate_response(user_input)
-
-    for response in response_list:
-        if response.type == 'text':
-            content = response.data
-            st.session_state.messages.append({"role": "assistant", "content": content})
-            st.chat_message("assistant").markdown(content)
-
-        elif response.type == 'tool-calling':
-            content = f"tool calling ...\n```\n{response.data}\n```"
-            st.session_state.messages.append({"role": "assistant", "content": content})
-            st.chat_message("assistant").markdown(content)
+    placeholder, text = None, ''
+    try:
+        for response in generate_response(user_input):
+            if response.type == 'text':
+                if response.partial:
+                    if placeholder is None:
+                        placeholder = st.chat_message("assistant").empty()
+
+                    text += response.data
+                    placeholder.markdown(text)
+                    continue
+
+                content = response.data
+                st.session_state.messages.append({"role": "assistant", "content": content})
+                if placeholder is None:
+                    st.chat_message("assistant").markdown(content)
+                else:
+                    placeholder.markdown(content)
+
+            elif response.type == 'tool-calling':
+                content = f"tool calling ...\n```\n{response.data}\n```"
+                st.session_state.messages.append({"role": "assistant", "content": content})
+                st.chat_message("assistant").markdown(content)
         
-        elif response.type == 'tool-result':
-            content = f"tool result\n```json\n{response.data}\n```"
-            st.session_state.messages.append({"role": "assistant", "content": content})
-            st.chat_message("assistant").markdown(content)
+            elif response.type == 'tool-result':
+                content = f"tool result\n```json\n{response.data}\n```"
+                st.session_state.messages.append({"role": "assistant", "content": content})
+                st.chat_message("assistant").markdown(content)
+    except errors.ServiceBusy as e:
+        # another turn of this session or too many sessions are in progress
+        st.warning(f"The agent is busy, try again in a moment ({e})")